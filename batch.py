@@ -0,0 +1,206 @@
+"""Headless batch cell counting over many stack directories.
+
+Usage: python batch.py manifest.txt --out results.csv --workers 8 [--compactness 40 ...]
+
+The manifest lists one stack directory per line, or is a .csv file with a
+``directory`` column and optional per-stack parameter columns. Results are
+appended to the output (.csv, or .json/.jsonl for JSON lines) as each stack
+finishes; stacks already recorded as ok are skipped when the run is restarted.
+This module must not import PyQt5 or Mayavi.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from counting import BACKENDS, COUNTING_BACKEND, DEFAULT_PARAMS, PARAM_NAMES
+
+RESULT_FIELDS = ('directory',) + PARAM_NAMES + ('num_cells', 'status', 'error', 'seconds')
+# Finished stacks are added to the results store this many at a time, one transaction each
+RESULTS_BATCH = 32
+
+
+def read_manifest(path, defaults):
+    jobs = []
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [{'directory': line.strip()} for line in f if line.strip() and not line.startswith('#')]
+    for row in rows:
+        params = dict(defaults)
+        for name in PARAM_NAMES:
+            if row.get(name) not in (None, ''):
+                params[name] = type(defaults[name])(row[name])
+        if row.get('filename_template'):
+            params['filename_template'] = row['filename_template']
+        params['image_path'] = os.path.abspath(row['directory'])
+        jobs.append(params)
+    return jobs
+
+
+def job_key(params):
+    return json.dumps([params['image_path']] + [str(params[name]) for name in PARAM_NAMES])
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        if path.lower().endswith('.csv'):
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ResultWriter:
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.lower().endswith('.csv')
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, RESULT_FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, result):
+        if self.is_csv:
+            self.writer.writerow(result)
+        else:
+            self.file.write(json.dumps(result) + '\n')
+        # Flushed per stack, so an interrupted run keeps everything that finished
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def count_stack(params, backend=None, profile=False):
+    import instrumentation
+    from counting import CountingProgress, run_cell_counting
+    from volume_store import open_store
+
+    instrumentation.enable(profile)
+
+    result = {'directory': params['image_path']}
+    result.update((name, params[name]) for name in PARAM_NAMES)
+    start = time.perf_counter()
+    progress = CountingProgress()
+    try:
+        # One decode thread per stack, the process pool already spreads stacks across the cores
+        store = open_store(params['image_path'], params.get('filename_template'))
+        result['num_cells'] = int(run_cell_counting(params, store, loader_workers=1, progress=progress,
+                                                    backend=backend))
+        result['status'] = 'ok'
+        result['error'] = ''
+    except Exception as e:
+        result['num_cells'] = ''
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    result['timings'] = progress.timings
+    result['cells'] = progress.cells
+    if profile:
+        result['trace'] = instrumentation.drain()
+    return result
+
+
+def run_batch(jobs, out_path, workers=None, resume=True, backend=None, trace_path=None, results_db=None):
+    if resume:
+        done = {job_key({**row, 'image_path': row['directory']}) for row in read_results(out_path)
+                if row.get('status') == 'ok'}
+        jobs = [params for params in jobs if job_key(params) not in done]
+    writer = ResultWriter(out_path)
+    results = []
+    trace = []
+    # Runs and per-cell measurements also go to the results store when one is given
+    store = None
+    if results_db is not None:
+        from results_store import ResultsStore
+
+        store = ResultsStore(results_db)
+    pending = []
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {executor.submit(count_stack, params, backend, trace_path is not None): params
+                       for params in jobs}
+            try:
+                for future in as_completed(futures):
+                    result = future.result()
+                    trace.extend(result.pop('trace', ()))
+                    timings, cells = result.pop('timings'), result.pop('cells')
+                    writer.write(result)
+                    if store is not None:
+                        pending.append({'directory': result['directory'], 'params': futures[future],
+                                        'num_cells': result['num_cells'] if result['status'] == 'ok' else None,
+                                        'status': result['status'], 'error': result['error'],
+                                        'seconds': result['seconds'], 'timings': timings, 'cells': cells,
+                                        'backend': backend or COUNTING_BACKEND})
+                        if len(pending) >= RESULTS_BATCH:
+                            store.add_runs(pending)
+                            pending.clear()
+                    results.append(result)
+                    print(f"[{len(results)}/{len(jobs)}] {result['directory']}: "
+                          f"{result['num_cells'] if result['status'] == 'ok' else result['error']}", flush=True)
+            except KeyboardInterrupt:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        writer.close()
+        if store is not None:
+            if pending:
+                store.add_runs(pending)
+            store.close()
+        if trace_path is not None:
+            from instrumentation import export_chrome_trace, format_summary, summary
+
+            export_chrome_trace(trace_path, trace)
+            print(format_summary(summary(trace)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Count cells in many stack directories without the GUI.')
+    parser.add_argument('manifest', help='text file with one directory per line, or a .csv with a directory column')
+    parser.add_argument('--out', default='results.csv', help='results file, .csv or .json/.jsonl (JSON lines)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--no-resume', action='store_true', help='recount stacks already recorded as ok')
+    parser.add_argument('--backend', choices=BACKENDS, default=COUNTING_BACKEND, help='counting pipeline')
+    parser.add_argument('--trace', default=None, help='record per-stage timings and write a Chrome trace JSON here')
+    parser.add_argument('--results-db', dest='results_db', nargs='?', const='', default=None,
+                        help='also append runs and per-cell measurements to this SQLite results store '
+                             '(default location without a path)')
+    parser.add_argument('--refer-type', dest='refer_type', choices=('mean', 'median', 'larger100'),
+                        default=DEFAULT_PARAMS['refer_type'])
+    parser.add_argument('--supervoxels', dest='numOfSupervoxel', type=int, default=DEFAULT_PARAMS['numOfSupervoxel'])
+    parser.add_argument('--compactness', type=int, default=DEFAULT_PARAMS['compactness'])
+    parser.add_argument('--at-least-bright', dest='atLeastBright', type=int, default=DEFAULT_PARAMS['atLeastBright'])
+    parser.add_argument('--at-least-vol', dest='atLeastVol', type=int, default=DEFAULT_PARAMS['atLeastVol'])
+    parser.add_argument('--threshold', type=int, default=DEFAULT_PARAMS['threshold'])
+    parser.add_argument('--width', type=int, default=DEFAULT_PARAMS['width'])
+    parser.add_argument('--height', type=int, default=DEFAULT_PARAMS['height'])
+    parser.add_argument('--stack-num', dest='stack_num', type=int, default=DEFAULT_PARAMS['stack_num'])
+    parser.add_argument('--filename-template', dest='filename_template', default=None,
+                        help='slice file name with a {} field for the Z index, e.g. "C001Z{:03d}.tif"')
+    args = parser.parse_args(argv)
+
+    defaults = {name: getattr(args, name) for name in PARAM_NAMES}
+    if args.filename_template:
+        defaults['filename_template'] = args.filename_template
+    jobs = read_manifest(args.manifest, defaults)
+    if args.results_db == '':
+        from results_store import RESULTS_PATH
+
+        args.results_db = RESULTS_PATH
+    results = run_batch(jobs, args.out, args.workers, resume=not args.no_resume, backend=args.backend,
+                        trace_path=args.trace, results_db=args.results_db)
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f'{len(results) - failed} stacks counted, {failed} failed, results in {args.out}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,416 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from slice_index import DEFAULT_TEMPLATE
+
+SUITE_SIZES = ((64, 512), (256, 1024))
+HEAVY_MODULES = ('mayavi', 'vtk', 'matplotlib', 'skimage', 'sense_v2')
+# Run in a fresh interpreter: the steps main.py takes to show the window, and which heavy modules they pulled in
+STARTUP_SCRIPT = '''
+import json, os, sys, time
+started = time.perf_counter()
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication
+import main
+app = QApplication(sys.argv)
+window, timings = main.start(app)
+timings['imports to window'] = time.perf_counter() - started
+timings['loaded'] = [name for name in %r if name in sys.modules]
+print(json.dumps(timings))
+''' % (HEAVY_MODULES,)
+DATA_ROOT = os.path.join(tempfile.gettempdir(), 'sense_benchmark')
+
+
+def synthetic_stack(slices, size, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(slices, size, size, 3), dtype=np.uint8)
+
+
+def synthetic_volume(slices, size, seed=0):
+    # Grayscale stack whose brightness drifts with depth, like light attenuation in a spheroid
+    rng = np.random.default_rng(seed)
+    gain = np.linspace(1.0, 0.3, slices, dtype=np.float32)[:, np.newaxis, np.newaxis]
+    noise = rng.random((slices, size, size), dtype=np.float32)
+    return (noise * gain * 255).astype(np.uint8)
+
+
+def write_spheroid_stack(directory, slices, size, seed=0, template=DEFAULT_TEMPLATE):
+    """Directory of synthetic spheroid slices named like a microscope export, reused once complete.
+
+    The spheroid is a faint ellipsoid packed with brighter ellipsoidal cells
+    (about 30% of its volume), dimmer with depth and with Gaussian noise. The
+    number of cells and their volume in voxels are written to ``spheroid.json``
+    next to the slices.
+    """
+    import cv2
+
+    meta_path = os.path.join(directory, 'spheroid.json')
+    if os.path.exists(meta_path):
+        return directory
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    radius, depth = 0.4 * size, 0.45 * slices
+    cell_radius = max(size / 40, 3.0)
+    cell_depth = max(cell_radius * slices / size * 2, 3.0)
+    n_cells = int(0.3 * (radius / cell_radius) ** 2 * depth / cell_depth)
+    # Cell centres spread uniformly over the spheroid
+    directions = rng.normal(size=(n_cells, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    centres = directions * rng.random((n_cells, 1)) ** (1 / 3)
+    cx, cy = size / 2 + centres[:, 0] * (radius - cell_radius), size / 2 + centres[:, 1] * (radius - cell_radius)
+    cz = slices / 2 + centres[:, 2] * (depth - cell_depth)
+    brightness = rng.uniform(120, 230, n_cells)
+
+    for z in range(slices):
+        gain = 1.0 - 0.6 * z / max(slices - 1, 1)
+        img = np.zeros((size, size), dtype=np.float32)
+        dz = (z - slices / 2) / depth
+        if abs(dz) < 1:
+            cv2.circle(img, (size // 2, size // 2), int(radius * np.sqrt(1 - dz ** 2)), 30.0, -1)
+        for i in np.flatnonzero(np.abs(cz - z) < cell_depth):
+            r = cell_radius * np.sqrt(1 - ((z - cz[i]) / cell_depth) ** 2)
+            cv2.circle(img, (int(cx[i]), int(cy[i])), max(int(r), 1), float(brightness[i]), -1)
+        img = img * gain + rng.normal(0, 8, img.shape).astype(np.float32)
+        cv2.imwrite(os.path.join(directory, template.format(z + 1)), np.clip(img, 0, 255).astype(np.uint8))
+    with open(meta_path, 'w') as f:
+        json.dump({'slices': slices, 'size': size, 'seed': seed, 'cells': n_cells,
+                   'cell_voxels': int(4 / 3 * np.pi * cell_radius ** 2 * cell_depth)}, f)
+    return directory
+
+
+def _bench_store(directory, cache_root):
+    from volume_store import VolumeStore
+
+    return VolumeStore(directory, cache_root=cache_root, template=DEFAULT_TEMPLATE)
+
+
+def _stack_bytes(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.tif'))
+
+
+def bench_load(directory, path='store', workers=None):
+    """Decode a slice directory either into the shared volume store or through the 2D viewer's lazy pager."""
+    from volume_store import SlicePager
+
+    cache_root = tempfile.mkdtemp(prefix='sense_bench_')
+    try:
+        store = _bench_store(directory, cache_root)
+        start = time.perf_counter()
+        if path == 'store':
+            store.load(workers)
+        else:
+            pager = SlicePager(store.paths, prefetch=0)
+            for i in range(len(pager)):
+                pager[i]
+            pager.close()
+        seconds = time.perf_counter() - start
+        result = {'benchmark': f'load_{path}', 'slices': len(store), 'seconds': seconds,
+                  'slices_per_second': len(store) / seconds,
+                  'megabytes_per_second': _stack_bytes(directory) / 2**20 / seconds}
+        if path == 'store':
+            # A second open finds the decoded volume in the cache
+            start = time.perf_counter()
+            _bench_store(directory, cache_root).load()
+            result['warm_open_seconds'] = time.perf_counter() - start
+        return result
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+
+def bench_stats(directory):
+    from slice_stats import SliceStats, slice_histogram
+
+    cache_root = tempfile.mkdtemp(prefix='sense_bench_')
+    try:
+        store = _bench_store(directory, cache_root).load()
+        start = time.perf_counter()
+        stats = SliceStats(np.array([slice_histogram(image_gray) for image_gray in store.gray]))
+        references = [stats.reference_index(refer_type) for refer_type in ('mean', 'median', 'larger100')]
+        seconds = time.perf_counter() - start
+        return {'benchmark': 'stats', 'slices': len(store), 'seconds': seconds,
+                'slices_per_second': len(store) / seconds, 'references': references}
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+
+def bench_counting(directory, size, backend='staged'):
+    from counting import DEFAULT_PARAMS, CountingProgress, run_cell_counting
+
+    cache_root = tempfile.mkdtemp(prefix='sense_bench_')
+    try:
+        store = _bench_store(directory, cache_root)
+        with open(os.path.join(directory, 'spheroid.json')) as f:
+            spheroid = json.load(f)
+        # Supervoxels about the size of a synthetic cell, and half a cell as the smallest one counted
+        params = dict(DEFAULT_PARAMS, image_path=directory, width=size, height=size,
+                      numOfSupervoxel=len(store) * size * size // spheroid['cell_voxels'],
+                      atLeastVol=spheroid['cell_voxels'] // 2, filename_template=DEFAULT_TEMPLATE)
+        progress = CountingProgress()
+        start = time.perf_counter()
+        num_cells = run_cell_counting(params, store, progress=progress, backend=backend)
+        seconds = time.perf_counter() - start
+        return {'benchmark': f'counting_{backend}', 'slices': len(store), 'seconds': seconds,
+                'slices_per_second': len(store) / seconds, 'num_cells': int(num_cells), 'true_cells': spheroid['cells'],
+                'stage_seconds': progress.timings}
+    finally:
+        shutil.rmtree(cache_root, ignore_errors=True)
+
+
+def bench_histmatch(slices=128, size=1024, refer_type='mean', workers=None, naive=True):
+    from histmatch import apply_luts, matching_luts
+    from slice_stats import SliceStats, slice_histogram
+
+    volume = synthetic_volume(slices, size)
+    start = time.perf_counter()
+    stats = SliceStats(np.array([slice_histogram(image_gray) for image_gray in volume]))
+    histogram_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = stats.reference_index(refer_type)
+    luts = matching_luts(stats.hist, stats.hist[reference])
+    apply_luts(volume, luts, out=volume, workers=workers)
+    match_seconds = time.perf_counter() - start
+    result = {'benchmark': 'histmatch', 'slices': slices, 'size': size,
+              'histogram_seconds': histogram_seconds, 'match_seconds': match_seconds,
+              'slices_per_second': slices / match_seconds,
+              'megabytes_per_second': volume.nbytes / 2**20 / match_seconds}
+
+    if naive:
+        # Per-slice quantile mapping with np.interp, the usual way of matching one image at a time
+        volume = synthetic_volume(slices, size)
+        start = time.perf_counter()
+        template = volume[reference].ravel()
+        template_values, template_counts = np.unique(template, return_counts=True)
+        template_quantiles = np.cumsum(template_counts) / template.size
+        for i in range(slices):
+            values, indices, counts = np.unique(volume[i].ravel(), return_inverse=True, return_counts=True)
+            quantiles = np.cumsum(counts) / volume[i].size
+            volume[i] = np.interp(quantiles, template_quantiles, template_values)[indices].reshape(size, size)
+        result['naive_seconds'] = time.perf_counter() - start
+        result['speedup'] = result['naive_seconds'] / match_seconds
+    return result
+
+
+def bench_labelstats(slices=64, size=512, supervoxels=25000, naive=True):
+    from label_stats import label_stats
+
+    # Box-shaped supervoxels of about the requested count stand in for a SLIC segmentation
+    step = max(int(round((slices * size * size / supervoxels) ** (1 / 3))), 1)
+    z, y, x = np.indices((slices, size, size), sparse=True)
+    grid = -(-size // step)
+    labels = ((z // step) * grid * grid + (y // step) * grid + x // step + 1).astype(np.int32)
+    volume = synthetic_volume(slices, size)
+    start = time.perf_counter()
+    label_stats(labels, volume)
+    first_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    stats = label_stats(labels, volume)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cells = stats.select(100, 10, merge=True)
+    result = {'benchmark': 'labelstats', 'slices': slices, 'size': size, 'labels': len(stats) - 1,
+              'edges': len(stats.edges), 'first_seconds': first_seconds, 'seconds': seconds,
+              'select_merge_seconds': time.perf_counter() - start, 'cells': len(cells)}
+
+    if naive:
+        from scipy import ndimage
+
+        index = np.arange(1, len(stats))
+        start = time.perf_counter()
+        ndimage.sum_labels(np.ones_like(volume), labels, index)
+        ndimage.mean(volume, labels, index)
+        ndimage.maximum(volume, labels, index)
+        ndimage.find_objects(labels)
+        ndimage.center_of_mass(np.ones_like(volume), labels, index)
+        result['naive_seconds'] = time.perf_counter() - start
+        result['speedup'] = result['naive_seconds'] / seconds
+    return result
+
+
+def bench_startup(runs=5):
+    """Seconds from launching a fresh interpreter until the main window is shown, median of ``runs``."""
+    launches, steps = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        launches.append(time.perf_counter() - start)
+        steps.append(json.loads(output.strip().splitlines()[-1]))
+    result = {'benchmark': 'startup', 'runs': runs, 'seconds': float(np.median(launches)),
+              'first_run_seconds': launches[0], 'loaded_heavy_modules': steps[-1]['loaded']}
+    for name in ('import ui', 'build window', 'show window', 'imports to window'):
+        result[f'{name.replace(" ", "_")}_seconds'] = float(np.median([step[name] for step in steps]))
+    return result
+
+
+def bench_redraw(slices=32, size=2048, sweeps=4):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication, QMainWindow
+    from visualizer import StackedWidget
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    window = QMainWindow()
+    window.stacked = synthetic_stack(slices, size)
+    window.length_of_namelist = slices
+    widget = StackedWidget(window)
+    window.setCentralWidget(widget)
+    window.show()
+    app.processEvents()
+
+    frames = []
+    widget.canvas.mpl_connect('draw_event', lambda event: frames.append(time.perf_counter()))
+    ticks = 0
+    start = time.perf_counter()
+    for sweep in range(sweeps):
+        layers = range(slices) if sweep % 2 == 0 else range(slices - 1, -1, -1)
+        for layer in layers:
+            widget.slider.setValue(layer)
+            app.processEvents()
+            ticks += 1
+    # Let the last coalesced redraw land before stopping the clock
+    widget.canvas.draw()
+    elapsed = time.perf_counter() - start
+    window.close()
+    return {'benchmark': 'redraw', 'slices': slices, 'size': size, 'ticks': ticks,
+            'frames': len(frames), 'seconds': elapsed, 'fps': len(frames) / elapsed,
+            'ticks_per_second': ticks / elapsed}
+
+
+def _measure(function, args):
+    from instrumentation import peak_rss
+
+    result = function(*args)
+    peak = peak_rss()
+    result['peak_rss_mb'] = None if peak is None else peak / 2**20
+    return result
+
+
+def isolated(function, *args):
+    # Every measurement runs in a fresh process, so the peak RSS it reports is its own
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_measure, function, args).result()
+
+
+def run_metadata():
+    import cv2
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'run': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'numpy': np.__version__,
+            'opencv': cv2.__version__}
+
+
+def run_suite(sizes=SUITE_SIZES, out='benchmarks.jsonl', data_root=DATA_ROOT, backend='staged', redraw=True):
+    """Benchmark every stage on synthetic spheroid stacks and append one JSON line per measurement to ``out``."""
+    metadata = run_metadata()
+    rows = []
+
+    def record(row):
+        rows.append(row)
+        with open(out, 'a') as f:
+            f.write(json.dumps(row) + '\n')
+
+    try:
+        result = bench_startup()
+        print(f"startup: {result['seconds']:.2f}s", flush=True)
+    except Exception as e:
+        result = {'benchmark': 'startup', 'error': f'{type(e).__name__}: {e}'}
+        print(f"startup: {result['error']}", flush=True)
+    record(dict(metadata, **result))
+    for slices, size in sizes:
+        directory = write_spheroid_stack(os.path.join(data_root, f'spheroid_{slices}x{size}'), slices, size)
+        cases = [(bench_load, directory, 'store'), (bench_load, directory, 'viewer'), (bench_stats, directory),
+                 (bench_counting, directory, size, backend)]
+        if redraw:
+            cases.append((bench_redraw, min(slices, 64), size, 2))
+        for function, *args in cases:
+            try:
+                result = isolated(function, *args)
+            except Exception as e:
+                result = {'benchmark': function.__name__[len('bench_'):], 'error': f'{type(e).__name__}: {e}'}
+            row = dict(metadata, stack=f'{slices}x{size}', **result)
+            record(row)
+            print(f"{slices}x{size} {row['benchmark']}: " + (row['error'] if 'error' in row else
+                  f"{row['seconds']:.2f}s, peak {row['peak_rss_mb'] or 0:.0f} MB"), flush=True)
+    return rows
+
+
+def parse_size(text):
+    slices, size = text.lower().split('x')
+    return int(slices), int(size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SENSE performance benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    redraw = subparsers.add_parser('redraw', help='2D viewer frames per second while scrubbing the slider')
+    redraw.add_argument('--slices', type=int, default=32)
+    redraw.add_argument('--size', type=int, default=2048)
+    redraw.add_argument('--sweeps', type=int, default=4)
+
+    histmatch = subparsers.add_parser('histmatch', help='histogram matching of a synthetic stack to its reference slice')
+    histmatch.add_argument('--slices', type=int, default=128)
+    histmatch.add_argument('--size', type=int, default=1024)
+    histmatch.add_argument('--refer-type', dest='refer_type', choices=('mean', 'median', 'larger100'), default='mean')
+    histmatch.add_argument('--workers', type=int, default=None)
+    histmatch.add_argument('--no-naive', dest='naive', action='store_false', help='skip the per-slice baseline')
+
+    labelstats = subparsers.add_parser('labelstats', help='per-supervoxel statistics of a synthetic label volume')
+    labelstats.add_argument('--slices', type=int, default=64)
+    labelstats.add_argument('--size', type=int, default=512)
+    labelstats.add_argument('--supervoxels', type=int, default=25000)
+    labelstats.add_argument('--no-naive', dest='naive', action='store_false', help='skip the scipy.ndimage baseline')
+
+    suite = subparsers.add_parser('suite', help='loading, statistics, redraw and counting on synthetic spheroids')
+    suite.add_argument('--sizes', type=parse_size, nargs='+', default=SUITE_SIZES, metavar='SLICESxSIZE',
+                       help='stack sizes, e.g. 64x512 256x1024 1024x2048')
+    suite.add_argument('--out', default='benchmarks.jsonl', help='JSON lines file the results are appended to')
+    suite.add_argument('--data-dir', default=DATA_ROOT, help='where the synthetic stacks are generated and kept')
+    suite.add_argument('--backend', choices=('staged', 'sense'), default='staged')
+    suite.add_argument('--no-redraw', dest='redraw', action='store_false', help='skip the Qt viewer benchmark')
+
+    startup = subparsers.add_parser('startup', help='seconds from launch until the main window is shown')
+    startup.add_argument('--runs', type=int, default=5)
+
+    spheroid = subparsers.add_parser('spheroid', help='only generate a synthetic spheroid stack')
+    spheroid.add_argument('directory')
+    spheroid.add_argument('--slices', type=int, default=64)
+    spheroid.add_argument('--size', type=int, default=512)
+    spheroid.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.benchmark == 'suite':
+        run_suite(args.sizes, args.out, args.data_dir, args.backend, args.redraw)
+        return
+    if args.benchmark == 'spheroid':
+        print(write_spheroid_stack(args.directory, args.slices, args.size, args.seed))
+        return
+    if args.benchmark == 'startup':
+        result = bench_startup(args.runs)
+    elif args.benchmark == 'redraw':
+        result = bench_redraw(args.slices, args.size, args.sweeps)
+    elif args.benchmark == 'histmatch':
+        result = bench_histmatch(args.slices, args.size, args.refer_type, args.workers, args.naive)
+    elif args.benchmark == 'labelstats':
+        result = bench_labelstats(args.slices, args.size, args.supervoxels, args.naive)
+    for key, value in result.items():
+        print(f'{key}: {value:.2f}' if isinstance(value, float) else f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""Single-file, chunked and compressed volume format (.svol).
+
+Usage: python chunked_volume.py STACK_DIR OUT.svol [--voxel-size Z Y X] [--chunks 16 256 256]
+
+A packed stack is one file: zlib-compressed chunks of the grayscale volume
+(and of the color volume when the channels differ), followed by a JSON footer
+with the chunk index, slice order, dtype, voxel size and per-slice
+histograms. Readers decompress only the chunks a request touches, so opening
+a stack needs one file handle and no TIFF decoding.
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+import numpy as np
+
+from disk_cache import publish, temp_path, touch
+from slice_stats import SliceStats
+
+EXTENSION = '.svol'
+MAGIC = b'SVOL\x00\x01'
+DEFAULT_CHUNKS = (16, 256, 256)
+CHUNK_CACHE_BUDGET = int(os.environ.get('SENSE_CHUNK_CACHE_MB', 256)) * 2**20
+
+
+def is_chunked_volume(path):
+    return os.path.isfile(path) and path.lower().endswith(EXTENSION)
+
+
+def _chunk_grid(shape, chunks):
+    return tuple(-(-size // chunk) for size, chunk in zip(shape, chunks))
+
+
+def _chunk_box(index, shape, chunks):
+    return tuple(slice(i * chunk, min((i + 1) * chunk, size)) for i, chunk, size in zip(index, chunks, shape))
+
+
+def pack_volume(path, datasets, meta, chunks=DEFAULT_CHUNKS, level=6, workers=None, progress=None):
+    """Write ``datasets`` (name -> array of (slice, row, col[, channel])) into one .svol file."""
+    tmp_path = temp_path(path)
+    index = {}
+    with open(tmp_path, 'wb') as f, ThreadPoolExecutor(workers) as executor:
+        f.write(MAGIC)
+        for name, array in datasets.items():
+            array_chunks = tuple(chunks) + tuple(array.shape[3:])
+            grid = _chunk_grid(array.shape[:3], chunks)
+            offsets = []
+            # Chunks are compressed in parallel (zlib releases the GIL) and written in index order
+            for z in range(grid[0]):
+                boxes = [_chunk_box((z,) + yx, array.shape, array_chunks) for yx in product(*map(range, grid[1:]))]
+                compress = lambda box: zlib.compress(np.ascontiguousarray(array[box]).tobytes(), level)
+                for data in executor.map(compress, boxes):
+                    offsets.append((f.tell(), len(data)))
+                    f.write(data)
+                if progress is not None:
+                    progress(z + 1, grid[0])
+            index[name] = {'shape': list(array.shape), 'dtype': str(array.dtype), 'chunks': list(array_chunks),
+                           'offsets': offsets}
+        footer = json.dumps(dict(meta, datasets=index)).encode()
+        f.write(footer)
+        f.write(struct.pack('<Q', len(footer)))
+        f.write(MAGIC)
+    os.replace(tmp_path, path)
+    return path
+
+
+def pack_directory(directory, path, voxel_size=(1.0, 1.0, 1.0), chunks=DEFAULT_CHUNKS, level=6, workers=None,
+                   progress=None, template=None):
+    from volume_store import open_store
+
+    store = open_store(directory, template).load(workers)
+    datasets = {'gray': store.gray}
+    # The color volume is only kept when its channels actually differ
+    if any(not (np.array_equal(img[..., 0], img[..., 1]) and np.array_equal(img[..., 0], img[..., 2]))
+           for img in store.color):
+        datasets['color'] = store.color
+    meta = {'namelist': store.namelist, 'source': store.directory, 'voxel_size': list(voxel_size),
+            'hist': store.stats().hist.tolist()}
+    return pack_volume(path, datasets, meta, chunks, level, workers, progress)
+
+
+class ChunkedVolume:
+    def __init__(self, path, cache_budget=CHUNK_CACHE_BUDGET):
+        self.path = os.path.abspath(path)
+        self.file = open(self.path, 'rb')
+        self.file.seek(-len(MAGIC) - 8, os.SEEK_END)
+        footer_size = struct.unpack('<Q', self.file.read(8))[0]
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a packed SENSE volume')
+        self.file.seek(-len(MAGIC) - 8 - footer_size, os.SEEK_END)
+        self.meta = json.loads(self.file.read(footer_size))
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_budget = cache_budget
+        self.datasets = {name: ChunkedArray(self, name, info) for name, info in self.meta['datasets'].items()}
+
+    def read_chunk(self, name, number, shape, dtype):
+        key = (name, number)
+        with self.lock:
+            chunk = self.cache.get(key)
+            if chunk is not None:
+                self.cache.move_to_end(key)
+                return chunk
+            offset, length = self.meta['datasets'][name]['offsets'][number]
+            self.file.seek(offset)
+            data = self.file.read(length)
+        chunk = np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(shape)
+        with self.lock:
+            self.cache[key] = chunk
+            self.cache_bytes += chunk.nbytes
+            while self.cache_bytes > self.cache_budget and len(self.cache) > 1:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted.nbytes
+        return chunk
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkedArray:
+    """Read-only array view of one dataset; indexing decompresses only the chunks it touches."""
+
+    def __init__(self, volume, name, info):
+        self.volume = volume
+        self.name = name
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.chunks = tuple(info['chunks'])
+        self.grid = _chunk_grid(self.shape[:3], self.chunks)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        bounds, post = [], []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + size if k < 0 else int(k)
+                if not 0 <= k < size:
+                    raise IndexError(f'index {k} is out of bounds for axis with size {size}')
+                bounds.append((k, k + 1))
+                post.append(0)
+            elif isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step == 1:
+                    bounds.append((start, max(stop, start)))
+                    post.append(slice(None))
+                else:
+                    bounds.append((0, size))
+                    post.append(k)
+            else:
+                raise TypeError(f'ChunkedArray only supports integer and slice indices, not {type(k).__name__}')
+
+        out = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+        ranges = [range(start // chunk, -(-stop // chunk)) for (start, stop), chunk in zip(bounds[:3], self.chunks)]
+        for index in product(*ranges):
+            box = _chunk_box(index, self.shape, self.chunks)
+            number = (index[0] * self.grid[1] + index[1]) * self.grid[2] + index[2]
+            chunk_shape = tuple(s.stop - s.start for s in box) + self.shape[3:]
+            chunk = self.volume.read_chunk(self.name, number, chunk_shape, self.dtype)
+            source, target = [], []
+            for s, (start, stop) in zip(box, bounds):
+                low, high = max(s.start, start), min(s.stop, stop)
+                source.append(slice(low - s.start, high - s.start))
+                target.append(slice(low - start, high - start))
+            # Channel axes are never chunked, so they are read straight from the requested bounds
+            source.extend(slice(start, stop) for start, stop in bounds[3:])
+            out[tuple(target)] = chunk[tuple(source)]
+        return out[tuple(post)]
+
+
+class _GrayAsColor:
+    # BGR view of a grayscale dataset for stacks whose channels were identical
+    def __init__(self, gray):
+        self.gray = gray
+        self.shape = gray.shape + (3,)
+        self.dtype = gray.dtype
+
+    def __len__(self):
+        return len(self.gray)
+
+    def __getitem__(self, key):
+        gray = self.gray[key[:3] if isinstance(key, tuple) else key]
+        color = np.repeat(gray[..., np.newaxis], 3, axis=-1)
+        return color[(Ellipsis, key[3])] if isinstance(key, tuple) and len(key) > 3 else color
+
+
+class ChunkedStore:
+    """Volume store backed by a packed .svol file, interchangeable with ``VolumeStore``."""
+
+    def __init__(self, path, cache_root=None):
+        from volume_store import CACHE_ROOT
+
+        self.directory = os.path.abspath(path)
+        self.template = None
+        self.issues = []
+        self.volume = ChunkedVolume(self.directory)
+        self.namelist = self.volume.meta['namelist']
+        self.paths = [self.directory] * len(self.namelist)
+        self.voxel_size = tuple(self.volume.meta.get('voxel_size', (1.0, 1.0, 1.0)))
+        stat = os.stat(self.directory)
+        self.key = hashlib.sha1(f'{self.directory}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode()).hexdigest()
+        self.cache_dir = os.path.join(cache_root or CACHE_ROOT, self.key)
+        self._mark()
+        self.gray = self.volume.datasets['gray']
+        self.color = self.volume.datasets['color'] if 'color' in self.volume.datasets else _GrayAsColor(self.gray)
+
+    def __len__(self):
+        return len(self.namelist)
+
+    @property
+    def is_loaded(self):
+        return True
+
+    def is_stale(self):
+        stat = os.stat(self.directory)
+        return hashlib.sha1(f'{self.directory}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode()).hexdigest() != self.key
+
+    def _mark(self):
+        # Marks the cache entry for eviction like a decoded stack's meta.json, and recreates an evicted entry
+        meta_path = os.path.join(self.cache_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = temp_path(meta_path)
+            with open(tmp_path, 'w') as f:
+                json.dump({'directory': self.directory, 'namelist': self.namelist}, f)
+            publish(tmp_path, meta_path)
+
+    def load(self, workers=None, use_processes=None, progress=None):
+        self._mark()
+        touch(self.cache_dir)
+        return self
+
+    def stats(self):
+        return SliceStats(np.array(self.volume.meta['hist']).reshape(len(self), 256))
+
+    def level(self, factor):
+        from pyramid import load_level
+
+        volume = load_level(self.gray, self.load().cache_dir, factor)
+        return np.asarray(volume) if factor == 1 else volume
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pack a directory of .tif slices into one .svol volume file.')
+    parser.add_argument('directory')
+    parser.add_argument('out')
+    parser.add_argument('--voxel-size', type=float, nargs=3, default=(1.0, 1.0, 1.0), metavar=('Z', 'Y', 'X'))
+    parser.add_argument('--chunks', type=int, nargs=3, default=DEFAULT_CHUNKS, metavar=('Z', 'Y', 'X'))
+    parser.add_argument('--level', type=int, default=6, help='zlib compression level')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--template', default=None, help='filename template giving the Z index, e.g. "C001Z{:03d}.tif"')
+    args = parser.parse_args(argv)
+    out = args.out if args.out.lower().endswith(EXTENSION) else args.out + EXTENSION
+    pack_directory(args.directory, out, args.voxel_size, args.chunks, args.level, args.workers,
+                   progress=lambda done, total: print(f'\r{done}/{total} chunk rows', end='', flush=True),
+                   template=args.template)
+    print(f'\nPacked {args.directory} into {out}')
+
+
+if __name__ == '__main__':
+    main()
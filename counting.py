@@ -0,0 +1,292 @@
+import inspect
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty
+import cv2
+import numpy as np
+import instrumentation
+from disk_cache import publish, temp_path
+from histmatch import match_store
+from segmentation import SLIC_MEMORY_BUDGET, SLIC_WORKERS, tiled_slic
+from volume_store import open_store
+
+PARAM_NAMES = ('refer_type', 'numOfSupervoxel', 'compactness', 'atLeastBright', 'atLeastVol',
+               'threshold', 'width', 'height', 'stack_num')
+DEFAULT_PARAMS = {
+    'refer_type': 'mean',
+    'numOfSupervoxel': 25000,
+    'compactness': 50,
+    'atLeastBright': 10,
+    'atLeastVol': 800,
+    'threshold': 40,
+    'width': 512,
+    'height': 512,
+    'stack_num': 2,
+}
+# Pipeline stages with the share of the overall progress bar each one covers
+STAGES = (
+    ('loading', 0.10),
+    ('histogram matching', 0.20),
+    ('SLIC', 0.45),
+    ('filtering', 0.15),
+    ('counting', 0.10),
+)
+CANCEL_GRACE = 5.0
+# 'sense' runs sense_v2.perform_cell_counting, 'staged' the histogram matching / tiled SLIC pipeline below
+BACKENDS = ('sense', 'staged')
+COUNTING_BACKEND = os.environ.get('SENSE_COUNTING_BACKEND', 'sense')
+# Join touching supervoxels that pass the brightness filter into one cell before the volume filter
+MERGE_ADJACENT = os.environ.get('SENSE_MERGE_ADJACENT', '') == '1'
+
+
+class CountingCancelled(Exception):
+    pass
+
+
+class CountingProgress:
+    """Progress and cancellation token handed through the counting pipeline.
+
+    Stages call ``update(stage, fraction)``; the token turns that into overall
+    progress for ``callback(fraction, message)``, records per-stage wall time
+    in ``timings`` and raises ``CountingCancelled`` once ``cancel()`` was
+    called, so every progress report is also a cancellation point. The
+    staged pipeline leaves the ``LabelStats`` of the counted cells in
+    ``cells``.
+    """
+
+    def __init__(self, callback=None, stages=STAGES, cancel_event=None):
+        self.callback = callback
+        self.weights = dict(stages)
+        self.offsets = {}
+        offset = 0.0
+        for name, weight in stages:
+            self.offsets[name] = offset
+            offset += weight
+        self.cancel_event = cancel_event or threading.Event()
+        self.timings = {}
+        self.cells = None
+        self._started = {}
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check(self):
+        if self.cancelled:
+            raise CountingCancelled()
+
+    def update(self, stage, fraction):
+        self.check()
+        start = self._started.setdefault(stage, time.perf_counter())
+        elapsed = time.perf_counter() - start
+        if self.callback is not None:
+            overall = self.offsets[stage] + self.weights[stage] * min(max(fraction, 0.0), 1.0)
+            self.callback(overall, f'{stage.capitalize()}: {fraction:.0%} ({elapsed:.1f}s)')
+
+    @contextmanager
+    def stage(self, name):
+        self.update(name, 0.0)
+        with instrumentation.span(name, 'counting'):
+            yield self
+        self.timings[name] = time.perf_counter() - self._started[name]
+        self.update(name, 1.0)
+
+
+def sense_counter():
+    # sense_v2 is imported on first use; only the sense backend needs it
+    from sense_v2 import perform_cell_counting
+    return perform_cell_counting
+
+
+def accepts(name):
+    return name in inspect.signature(sense_counter()).parameters
+
+
+def fit_slices(volume, width, height, cache_dir, name):
+    # Slices are resized to the requested width x height once, into a memmap next to the volume
+    if volume.shape[1:] == (height, width):
+        return volume
+    path = os.path.join(cache_dir, f'{name}_{width}x{height}.npy')
+    if not os.path.exists(path):
+        tmp_path = temp_path(path)
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=volume.dtype,
+                                        shape=(len(volume), height, width))
+        for i, image in enumerate(volume):
+            out[i] = cv2.resize(np.asarray(image), (width, height), interpolation=cv2.INTER_AREA)
+        out.flush()
+        del out
+        publish(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def matched_volume(store, params, progress, loader_workers=None):
+    with progress.stage('loading'):
+        store.load(loader_workers, progress=lambda done, total: progress.update('loading', done / total))
+    refer_type = params['refer_type']
+    with progress.stage('histogram matching'):
+        matched = match_store(store, refer_type,
+                              progress=lambda done, total: progress.update('histogram matching', done / total))
+        return fit_slices(matched, params['width'], params['height'], store.cache_dir, f'matched_{refer_type}')
+
+
+def supervoxels_path(store, params):
+    return os.path.join(store.cache_dir, 'supervoxels_{refer_type}_{width}x{height}_n{numOfSupervoxel}'
+                                         '_c{compactness}_t{threshold}.npz'.format(**params))
+
+
+def supervoxels(store, matched, params, progress, memory_budget=SLIC_MEMORY_BUDGET, workers=SLIC_WORKERS):
+    """``LabelStats`` of every supervoxel, cached per SLIC parameter set.
+
+    Only these per-label statistics are kept, so runs that change nothing
+    upstream of the filters skip the segmentation altogether.
+    """
+    from label_stats import LabelStats, label_stats
+
+    path = supervoxels_path(store, params)
+    if os.path.exists(path):
+        try:
+            return LabelStats.load(path)
+        except KeyError:
+            pass  # voxel counts and means only, cached before the other statistics were kept
+    # Labels live in a memmap, so volumes whose labels do not fit in RAM can still be segmented
+    labels_path = temp_path(os.path.join(store.cache_dir, 'labels.npy'))
+    labels = np.lib.format.open_memmap(labels_path, mode='w+', dtype=np.int32, shape=matched.shape)
+    try:
+        with progress.stage('SLIC'):
+            tiled_slic(matched, params['numOfSupervoxel'], params['compactness'], params['threshold'],
+                       memory_budget, workers, out=labels,
+                       progress=lambda fraction: progress.update('SLIC', fraction))
+        with instrumentation.span('label statistics', 'counting'):
+            stats = label_stats(labels, matched)
+    finally:
+        del labels
+        os.remove(labels_path)
+    stats.save(path)
+    return stats
+
+
+def filter_supervoxels(stats, params, merge=MERGE_ADJACENT):
+    return stats.select(params['atLeastVol'], params['atLeastBright'], params['threshold'], merge)
+
+
+def count_cells_staged(store, params, progress, loader_workers=None, memory_budget=SLIC_MEMORY_BUDGET,
+                       workers=SLIC_WORKERS):
+    """Count cells as the supervoxels that survive the brightness and volume filters.
+
+    Slices are histogram matched to the reference slice and resized to
+    ``width`` x ``height``; voxels below ``threshold`` are background. The
+    matched volume is segmented with tiled 3D SLIC into ``numOfSupervoxel``
+    supervoxels, and those with a mean intensity of at least ``atLeastBright``
+    and at least ``atLeastVol`` voxels are counted. With
+    ``SENSE_MERGE_ADJACENT=1`` touching bright supervoxels are joined into
+    one cell before the volume filter. ``stack_num`` only applies to the
+    sense backend.
+    """
+    matched = matched_volume(store, params, progress, loader_workers)
+    stats = supervoxels(store, matched, params, progress, memory_budget, workers)
+    with progress.stage('filtering'):
+        progress.cells = filter_supervoxels(stats, params)
+    with progress.stage('counting'):
+        return len(progress.cells)
+
+
+def run_cell_counting(params, store=None, loader_workers=None, progress=None, backend=None):
+    params = dict(params)
+    progress = progress or CountingProgress()
+    template = params.pop('filename_template', None)
+    if (backend or COUNTING_BACKEND) == 'staged':
+        return count_cells_staged(store or open_store(params['image_path'], template), params, progress,
+                                  loader_workers)
+    # Hand over the already decoded volume when the algorithm can take it instead of re-reading the files
+    if store is not None and accepts('volume'):
+        with progress.stage('loading'):
+            store.load(loader_workers, progress=lambda done, total: progress.update('loading', done / total))
+            params['volume'] = store.gray
+    elif os.path.isfile(params['image_path']):
+        raise ValueError('The sense pipeline reads slice directories; count packed volumes with the staged pipeline')
+    # Keep the algorithm on the same slice order as the viewer when it can be told about it
+    if accepts('namelist'):
+        params['namelist'] = (store or open_store(params['image_path'], template)).namelist
+    if accepts('filename_template') and template:
+        params['filename_template'] = template
+    perform_cell_counting = sense_counter()
+    if accepts('progress'):
+        params['progress'] = progress
+        return perform_cell_counting(**params)
+
+    # Without a progress argument the algorithm runs as a single step between two cancellation points
+    progress.update('histogram matching', 0.0)
+    with instrumentation.span('perform_cell_counting', 'counting'):
+        num_cells = perform_cell_counting(**params)
+    for name in ('histogram matching', 'SLIC', 'filtering', 'counting'):
+        progress.update(name, 1.0)
+    return num_cells
+
+
+def _count_in_child(params, directory, events, cancel_event, backend, profile):
+    progress = CountingProgress(lambda fraction, message: events.put(('progress', fraction, message)),
+                                cancel_event=cancel_event)
+    instrumentation.enable(profile)
+    try:
+        store = open_store(directory, params.get('filename_template')) if directory else None
+        num_cells = int(run_cell_counting(params, store, progress=progress, backend=backend))
+        # The child's spans travel back with the result, so the parent's trace covers the whole run
+        events.put(('done', num_cells, progress.timings, instrumentation.drain(), progress.cells))
+    except CountingCancelled:
+        events.put(('cancelled',))
+    except Exception as e:
+        events.put(('error', f'{type(e).__name__}: {e}'))
+
+
+def count_in_subprocess(params, progress, directory=None, grace=CANCEL_GRACE, backend=None):
+    """Run the counting in a child process that ``progress.cancel()`` stops within ``grace`` seconds.
+
+    The child stops cooperatively at its next progress report; one that is
+    stuck inside the algorithm is terminated after ``grace`` seconds, which
+    also hands all of its memory back.
+    """
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    cancel_event = context.Event()
+    process = context.Process(target=_count_in_child,
+                              args=(params, directory, events, cancel_event, backend, instrumentation.ENABLED),
+                              daemon=True)
+    process.start()
+    deadline = None
+    try:
+        while True:
+            if progress.cancelled and deadline is None:
+                cancel_event.set()
+                deadline = time.monotonic() + grace
+            if deadline is not None and time.monotonic() > deadline:
+                process.terminate()
+                raise CountingCancelled()
+            try:
+                event = events.get(timeout=0.1)
+            except Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f'Cell counting process exited with code {process.exitcode}')
+                continue
+            if event[0] == 'progress':
+                if progress.callback is not None:
+                    progress.callback(event[1], event[2])
+            elif event[0] == 'done':
+                progress.timings.update(event[2])
+                instrumentation.record(event[3])
+                progress.cells = event[4]
+                return event[1]
+            elif event[0] == 'cancelled':
+                raise CountingCancelled()
+            else:
+                raise RuntimeError(event[1])
+    finally:
+        process.join(grace)
+        if process.is_alive():
+            process.terminate()
+            process.join()
@@ -0,0 +1,88 @@
+"""Writing and trimming the on-disk cache that several processes share.
+
+Cache files are written under a name unique to the writing process and
+thread and moved into place once complete, so a reader never maps a file
+that is still being written and concurrent writers never truncate each
+other's files. ``trim_cache`` keeps the cache root under a size budget by
+removing the least recently used stack entries.
+"""
+import os
+import shutil
+import threading
+import time
+
+CACHE_BUDGET = int(os.environ.get('SENSE_CACHE_MB', 20480)) * 2**20
+# Entries used this recently are never evicted, so stacks other processes are working on stay put
+CACHE_GRACE = 600
+
+
+def temp_path(path):
+    # Same extension as ``path``, so numpy does not append its own
+    root, extension = os.path.splitext(path)
+    return f'{root}.{os.getpid()}_{threading.get_ident()}.tmp{extension}'
+
+
+def publish(tmp_path, path):
+    """Move a finished temporary file to ``path``, keeping the file of a writer that got there first."""
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Windows cannot replace a file another process has mapped; that file holds the same result
+        if not os.path.exists(path):
+            raise
+        os.remove(tmp_path)
+    return path
+
+
+def touch(directory):
+    # The directory's mtime is the entry's last use
+    try:
+        os.utime(directory)
+    except OSError:
+        pass
+
+
+def entry_size(directory):
+    size = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat().st_size
+            elif entry.is_dir(follow_symlinks=False):
+                size += entry_size(entry.path)
+    return size
+
+
+def trim_cache(root, budget=CACHE_BUDGET, keep=(), grace=CACHE_GRACE, marker='meta.json'):
+    """Remove the least recently used entries of ``root`` until it fits ``budget`` bytes.
+
+    Entries are the subdirectories holding a ``marker`` file; the marker is
+    removed first, so an entry that cannot be deleted completely (files still
+    mapped on Windows) is rebuilt on its next use. Directories in ``keep`` and
+    entries used within ``grace`` seconds are left alone. Returns the bytes
+    freed.
+    """
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False) and os.path.exists(os.path.join(entry.path, marker)):
+                    entries.append((entry.stat().st_mtime, entry.path, entry_size(entry.path)))
+    except OSError:
+        return 0
+    total = sum(size for _, _, size in entries)
+    freed = 0
+    now = time.time()
+    for mtime, path, size in sorted(entries):
+        if total - freed <= budget:
+            break
+        if os.path.abspath(path) in keep or now - mtime < grace:
+            continue
+        try:
+            os.remove(os.path.join(path, marker))
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        freed += size
+    return freed
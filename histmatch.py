@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from disk_cache import publish, temp_path
+from instrumentation import span
+
+MATCH_WORKERS = int(os.environ.get('SENSE_MATCH_WORKERS', 0)) or os.cpu_count() or 1
+MATCH_BATCH = 8
+
+
+def cumulative(hist):
+    hist = np.asarray(hist, dtype=np.float64)
+    cdf = np.cumsum(hist, axis=-1)
+    return cdf / np.maximum(cdf[..., -1:], 1)
+
+
+def matching_luts(hists, reference_hist):
+    """One 256-entry uint8 lookup table per slice mapping it onto the reference histogram.
+
+    Each grey level goes to the lowest reference level whose cumulative share
+    reaches the slice's cumulative share at that level. The reference CDF is
+    built once and all slices are resolved in a single searchsorted call.
+    """
+    reference_cdf = cumulative(reference_hist)
+    slice_cdfs = cumulative(hists)
+    luts = np.searchsorted(reference_cdf, slice_cdfs.ravel(), side='left')
+    return np.minimum(luts, 255).astype(np.uint8).reshape(len(slice_cdfs), 256)
+
+
+def _apply_batch(volume, luts, out, indices):
+    with span('match batch', 'histogram matching', first=indices[0], slices=len(indices)):
+        for i in indices:
+            # cv2.LUT releases the GIL, so batches run concurrently on the worker threads
+            out[i] = cv2.LUT(volume[i], luts[i])
+    return len(indices)
+
+
+def apply_luts(volume, luts, out=None, workers=None, batch=MATCH_BATCH, progress=None):
+    """Apply ``luts[i]`` to slice ``i`` of a uint8 (slice, row, col) volume.
+
+    Pass ``out=volume`` (a writable array or ``r+`` memmap) to match in place
+    without allocating a second volume. ``progress(done, total)`` is called
+    after each batch of slices.
+    """
+    if out is None:
+        out = np.empty_like(volume)
+    batches = [range(start, min(start + batch, len(volume))) for start in range(0, len(volume), batch)]
+    done = 0
+    with ThreadPoolExecutor(workers or MATCH_WORKERS) as executor:
+        try:
+            for count in executor.map(lambda indices: _apply_batch(volume, luts, out, indices), batches):
+                done += count
+                if progress is not None:
+                    progress(done, len(volume))
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return out
+
+
+def match_volume(volume, stats, refer_type, out=None, workers=None, progress=None):
+    reference = stats.reference_index(refer_type)
+    luts = matching_luts(stats.hist, stats.hist[reference])
+    return apply_luts(volume, luts, out, workers, progress=progress)
+
+
+def match_store(store, refer_type, workers=None, progress=None):
+    """Histogram-matched copy of a store's grayscale volume, cached as a memmap per reference type."""
+    volume = store.load().gray
+    path = os.path.join(store.cache_dir, f'matched_{refer_type}.npy')
+    if not os.path.exists(path):
+        tmp_path = temp_path(path)
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=volume.dtype, shape=volume.shape)
+        try:
+            match_volume(volume, store.stats(), refer_type, out, workers, progress)
+            out.flush()
+        finally:
+            del out
+        publish(tmp_path, path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,210 @@
+"""Opt-in timing of pipeline stages: wall time, CPU time and memory per span.
+
+Enable with ``SENSE_PROFILE=1`` or ``enable()``. While disabled ``span()``
+returns a shared no-op context manager, so instrumented code pays one flag
+check. Recorded spans can be summarised per name or exported in Chrome trace
+format (open it in chrome://tracing or https://ui.perfetto.dev).
+
+``cpu_s`` is the CPU time of the thread that ran the span and
+``process_cpu_s`` that of the whole process meanwhile, which is the useful
+one for stages that fan their work out to a thread pool. ``peak`` is the
+highest resident set size the process reached during the span and ``rss``
+the resident set size when it ended; both count every thread. The peak
+comes from Linux's VmHWM, reset at the start of every span; where that
+cannot be reset it is tracemalloc's peak, which covers Python and NumPy
+allocations only.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENABLED = os.environ.get('SENSE_PROFILE', '') == '1'
+
+_events = []
+_lock = threading.Lock()
+_null = nullcontext()
+# Peak seen by each open span since it started, and by the process since the high-water mark was first reset
+_open_peaks = {}
+_lifetime_peak = 0
+_peak_source = None
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None where it cannot be read."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes; spans reset the kernel's high-water mark
+        return max(peak if sys.platform == 'darwin' else peak * 1024, _lifetime_peak)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    return getattr(memory, 'peak_wset', memory.rss)
+
+
+def current_rss():
+    """Resident set size of this process right now in bytes, or None where it cannot be read."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def _high_water_mark():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def _reset_high_water_mark():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def _reset_peak():
+    global _lifetime_peak, _peak_source
+    if _peak_source is None:
+        try:
+            peak = _high_water_mark()
+            _reset_high_water_mark()
+            _peak_source = 'rss' if peak is not None else 'tracemalloc'
+            _lifetime_peak = peak or 0
+        except OSError:
+            _peak_source = 'tracemalloc'
+        if _peak_source == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+    elif _peak_source == 'rss':
+        _reset_high_water_mark()
+    else:
+        tracemalloc.reset_peak()
+
+
+def _fold_peak():
+    # Called with _lock held, before every reset and at every span end: the peak since the last reset counts
+    # for every span open meanwhile
+    global _lifetime_peak
+    if _peak_source == 'rss':
+        peak = _high_water_mark() or 0
+        _lifetime_peak = max(_lifetime_peak, peak)
+    elif _peak_source == 'tracemalloc':
+        peak = tracemalloc.get_traced_memory()[1]
+    else:
+        return
+    for token, seen in _open_peaks.items():
+        _open_peaks[token] = max(seen, peak)
+
+
+def span(name, category='', **args):
+    """Context manager recording one span, or a no-op while instrumentation is disabled."""
+    if not ENABLED:
+        return _null
+    return _span(name, category, args)
+
+
+@contextmanager
+def _span(name, category, args):
+    start = time.perf_counter_ns()
+    cpu_start = time.thread_time()
+    process_cpu_start = time.process_time()
+    token = object()
+    with _lock:
+        _fold_peak()
+        _open_peaks[token] = 0
+        _reset_peak()
+    try:
+        yield
+    finally:
+        rss = current_rss()
+        with _lock:
+            _fold_peak()
+            peak = _open_peaks.pop(token) or None
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start / 1000,
+                 'dur': (time.perf_counter_ns() - start) / 1000, 'pid': os.getpid(),
+                 'tid': threading.get_ident(),
+                 'args': dict(args, cpu_s=time.thread_time() - cpu_start,
+                              process_cpu_s=time.process_time() - process_cpu_start, peak=peak, rss=rss)}
+        with _lock:
+            _events.append(event)
+
+
+def record(events):
+    # Spans recorded in another process, e.g. the counting child
+    with _lock:
+        _events.extend(events)
+
+
+def events():
+    with _lock:
+        return list(_events)
+
+
+def drain():
+    with _lock:
+        drained = list(_events)
+        _events.clear()
+    return drained
+
+
+def clear():
+    drain()
+
+
+def summary(recorded=None):
+    """One row per span name: calls, total wall and CPU seconds, the highest peak memory of a call and the
+    highest RSS at the end of one."""
+    rows = {}
+    for event in events() if recorded is None else recorded:
+        row = rows.setdefault(event['name'], {'name': event['name'], 'category': event['cat'], 'calls': 0,
+                                              'wall_s': 0.0, 'cpu_s': 0.0, 'process_cpu_s': 0.0,
+                                              'peak': None, 'rss': None})
+        row['calls'] += 1
+        row['wall_s'] += event['dur'] / 1e6
+        row['cpu_s'] += event['args']['cpu_s']
+        row['process_cpu_s'] += event['args']['process_cpu_s']
+        for key in ('peak', 'rss'):
+            value = event['args'].get(key)
+            if value is not None:
+                row[key] = value if row[key] is None else max(row[key], value)
+    return sorted(rows.values(), key=lambda row: row['wall_s'], reverse=True)
+
+
+def export_chrome_trace(path, recorded=None):
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events() if recorded is None else recorded, 'displayTimeUnit': 'ms'}, f)
+    return path
+
+
+def format_megabytes(value):
+    return '' if value is None else f"{value / 2**20:.0f}"
+
+
+def format_summary(rows):
+    lines = [f"{'span':<32}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'proc cpu s':>12}{'peak MB':>9}{'RSS MB':>9}"]
+    for row in rows:
+        lines.append(f"{row['name']:<32}{row['calls']:>7}{row['wall_s']:>10.3f}{row['cpu_s']:>10.3f}"
+                     f"{row['process_cpu_s']:>12.3f}{format_megabytes(row['peak']):>9}"
+                     f"{format_megabytes(row['rss']):>9}")
+    return '\n'.join(lines)
@@ -0,0 +1,195 @@
+"""Queue of cell counting jobs that run concurrently within a core and memory budget.
+
+Every job counts one stack with one parameter set in its own child process
+(``count_in_subprocess``), so jobs are cancelled, and hand their memory back,
+independently. Jobs start in the order they were queued while fewer than
+``workers`` are running and their memory estimate fits next to the running
+ones; a job that does not fit waits, and the jobs behind it wait with it so
+large stacks are not starved by small ones. A job larger than the whole
+budget runs once nothing else does. Jobs on a stack whose decoded cache is
+not complete yet run one at a time, so the first one decodes it and the
+others reuse it. This module must not import PyQt5.
+"""
+import itertools
+import os
+import sqlite3
+import threading
+import time
+
+from counting import COUNTING_BACKEND, CountingCancelled, CountingProgress, count_in_subprocess
+from results_store import ResultsStore
+from segmentation import SLIC_BYTES_PER_VOXEL, SLIC_MEMORY_BUDGET
+from volume_store import open_store
+
+JOB_WORKERS = int(os.environ.get('SENSE_JOB_WORKERS', 0)) or os.cpu_count() or 1
+# Matched uint8 volume and int32 labels per voxel, on top of SLIC's working memory
+JOB_BYTES_PER_VOXEL = 5
+STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return 8 * 2**30
+    return psutil.virtual_memory().total
+
+
+JOB_MEMORY_BUDGET = int(os.environ.get('SENSE_JOB_MEMORY_MB', 0)) * 2**20 or physical_memory() * 3 // 4
+
+
+def estimate_memory(params, slices):
+    """Bytes a counting job needs for ``slices`` slices resized to ``width`` x ``height``."""
+    voxels = params['width'] * params['height'] * slices
+    return voxels * JOB_BYTES_PER_VOXEL + min(voxels * SLIC_BYTES_PER_VOXEL, SLIC_MEMORY_BUDGET)
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, params, backend, store, memory):
+        self.id = next(self._ids)
+        self.store = store
+        self.params = params
+        self.backend = backend
+        self.slices = len(store)
+        self.memory = memory
+        self.state = 'queued'
+        self.fraction = 0.0
+        self.message = 'Queued'
+        self.num_cells = None
+        self.cells = None
+        self.error = None
+        self.run_id = None
+        self.seconds = None
+        self.progress = CountingProgress()
+
+    @property
+    def directory(self):
+        return self.params['image_path']
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    @property
+    def cache_ready(self):
+        # The counting child decodes the stack into the shared cache unless meta.json marks it complete
+        return self.store.is_loaded or os.path.exists(os.path.join(self.store.cache_dir, 'meta.json'))
+
+
+class JobQueue:
+    """Runs submitted ``Job``s and reports every change to ``on_change(job)``.
+
+    ``on_change`` is called from the scheduler's worker threads; a GUI has to
+    hand it over to its own thread.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, memory_budget=JOB_MEMORY_BUDGET, on_change=None, save_results=True):
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.on_change = on_change
+        self.save_results = save_results
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def submit(self, params, backend=None, store=None):
+        store = store or open_store(params['image_path'], params.get('filename_template'))
+        job = Job(dict(params, image_path=store.directory), backend or COUNTING_BACKEND, store,
+                  estimate_memory(params, len(store)))
+        job.progress.callback = lambda fraction, message: self._progress(job, fraction, message)
+        with self.lock:
+            self.jobs.append(job)
+        self._changed(job)
+        self._schedule()
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            queued = job.state == 'queued'
+            if queued:
+                job.state, job.message = 'cancelled', 'Cancelled'
+        job.progress.cancel()
+        if queued:
+            self._changed(job)
+            self._schedule()
+
+    def cancel_all(self):
+        for job in list(self.jobs):
+            if not job.finished:
+                self.cancel(job)
+
+    def clear_finished(self):
+        with self.lock:
+            self.jobs = [job for job in self.jobs if not job.finished]
+
+    @property
+    def running(self):
+        return [job for job in self.jobs if job.state == 'running']
+
+    @property
+    def memory_in_use(self):
+        return sum(job.memory for job in self.running)
+
+    def _changed(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def _progress(self, job, fraction, message):
+        job.fraction, job.message = fraction, message
+        self._changed(job)
+        # Jobs waiting on this stack's cache can start as soon as loading has written it
+        if any(other.state == 'queued' and other.directory == job.directory for other in self.jobs):
+            self._schedule()
+
+    def _schedule(self):
+        started = []
+        with self.lock:
+            running = self.running
+            memory = sum(job.memory for job in running)
+            for job in self.jobs:
+                if job.state != 'queued':
+                    continue
+                # Waiting for another job to finish decoding the same stack does not hold up other stacks
+                if not job.cache_ready and any(other.directory == job.directory for other in running):
+                    continue
+                if len(running) >= self.workers or (running and memory + job.memory > self.memory_budget):
+                    break
+                job.state, job.message = 'running', 'Starting'
+                running.append(job)
+                memory += job.memory
+                started.append(job)
+        for job in started:
+            self._changed(job)
+            threading.Thread(target=self._run, args=(job,), name=f'job-{job.id}', daemon=True).start()
+
+    def _run(self, job):
+        start = time.perf_counter()
+        try:
+            job.num_cells = count_in_subprocess(job.params, job.progress, job.directory, backend=job.backend)
+        except CountingCancelled:
+            job.state, job.message = 'cancelled', 'Cancelled'
+        except Exception as e:
+            job.state, job.error, job.message = 'failed', str(e), f'Failed: {e}'
+        else:
+            job.seconds = time.perf_counter() - start
+            job.cells = job.progress.cells
+            job.fraction, job.message = 1.0, f'{job.num_cells} cells in {job.seconds:.1f}s'
+            if self.save_results:
+                self._save(job)
+            job.state = 'done'
+        self._changed(job)
+        self._schedule()
+
+    def _save(self, job):
+        # The count stands even when the results store cannot be written
+        try:
+            with ResultsStore() as results:
+                job.run_id = results.add_run(job.directory, job.params, job.num_cells, seconds=job.seconds,
+                                             timings=job.progress.timings, cells=job.cells, backend=job.backend)
+        except (sqlite3.Error, OSError) as e:
+            job.message += f' (not saved: {e})'
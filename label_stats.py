@@ -0,0 +1,216 @@
+"""Per-label statistics of a supervoxel label volume, compiled with Numba.
+
+One pass over the labels gives every label's voxel count, mean and max
+intensity, bounding box and centroid; a second one finds which labels touch
+(6-connectivity). Both walk the volume a slab of slices at a time, so label
+memmaps larger than RAM work. The kernels are cached on disk by Numba, so the
+JIT cost is paid on the first run only. The parallel kernel runs for one
+caller at a time: Numba's default workqueue threading layer aborts when
+several Python threads (sweep groups, GUI worker threads) enter it at once.
+"""
+import threading
+import numpy as np
+from numba import get_num_threads, njit, prange, types
+from numba.typed import Dict
+from disk_cache import publish, temp_path
+
+# Memory for the per-thread partial sums and for the slab of slices read at once
+PARTIALS_BUDGET = 64 * 2**20
+SLAB_BUDGET = 64 * 2**20
+# Bytes of partial results per label and thread: count, sum, max, 3 lower, 3 upper and 3 coordinate sums
+PARTIAL_BYTES = 12 * 8
+# Serializes _accumulate across Python threads; each call already uses every core
+_parallel_lock = threading.Lock()
+
+
+@njit(cache=True, inline='always')
+def _extend(lower, upper, coords, chunk, label, axis, position):
+    if position < lower[chunk, label, axis]:
+        lower[chunk, label, axis] = position
+    if position > upper[chunk, label, axis]:
+        upper[chunk, label, axis] = position
+    coords[chunk, label, axis] += position
+
+
+@njit(parallel=True, cache=True)
+def _accumulate(labels, volume, z0, voxels, sums, maxima, lower, upper, coords):
+    # Each chunk of rows accumulates into its own row of the partial arrays, so threads never share a slot
+    n_chunks = voxels.shape[0]
+    depth, height, width = labels.shape
+    for chunk in prange(n_chunks):
+        for z in range(depth):
+            for y in range(chunk * height // n_chunks, (chunk + 1) * height // n_chunks):
+                for x in range(width):
+                    label = labels[z, y, x]
+                    if label == 0:
+                        continue
+                    value = volume[z, y, x]
+                    voxels[chunk, label] += 1
+                    sums[chunk, label] += value
+                    if value > maxima[chunk, label]:
+                        maxima[chunk, label] = value
+                    _extend(lower, upper, coords, chunk, label, 0, z0 + z)
+                    _extend(lower, upper, coords, chunk, label, 1, y)
+                    _extend(lower, upper, coords, chunk, label, 2, x)
+
+
+@njit(cache=True)
+def _adjacency(labels, depth, n_labels, pairs):
+    # Neighbouring label pairs (a < b) go into ``pairs`` as a * n_labels + b; ``labels`` may carry one slice
+    # after the slab so pairs across the slab boundary are found too
+    last = -1
+    height, width = labels.shape[1], labels.shape[2]
+    for z in range(depth):
+        for y in range(height):
+            for x in range(width):
+                a = labels[z, y, x]
+                if a == 0:
+                    continue
+                for b in (labels[z, y, x + 1] if x + 1 < width else 0,
+                          labels[z, y + 1, x] if y + 1 < height else 0,
+                          labels[z + 1, y, x] if z + 1 < labels.shape[0] else 0):
+                    if b == 0 or b == a:
+                        continue
+                    key = np.int64(min(a, b)) * n_labels + max(a, b)
+                    # Neighbours repeat along a boundary, so most duplicates never reach the dict
+                    if key != last:
+                        pairs[key] = 0
+                        last = key
+
+
+@njit(cache=True)
+def _keys(pairs):
+    keys = np.empty(len(pairs), dtype=np.int64)
+    for i, key in enumerate(pairs.keys()):
+        keys[i] = key
+    return keys
+
+
+@njit(cache=True)
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+@njit(cache=True)
+def _components(edges, keep):
+    # Union-find over the edges between kept labels; each kept label maps to the smallest label it is joined to
+    parent = np.arange(len(keep))
+    for i in range(len(edges)):
+        a, b = edges[i, 0], edges[i, 1]
+        if keep[a] and keep[b]:
+            root_a, root_b = _find(parent, a), _find(parent, b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+    for i in range(len(keep)):
+        parent[i] = _find(parent, i) if keep[i] else 0
+    return parent
+
+
+def _slabs(labels, budget=SLAB_BUDGET):
+    depth = max(budget // max(labels[0].nbytes, 1), 1)
+    for z0 in range(0, len(labels), depth):
+        yield z0, min(z0 + depth, len(labels))
+
+
+class LabelStats:
+    """Statistics of the labels in ``labels``, one row per label.
+
+    ``bbox`` holds (z0, y0, x0, z1, y1, x1) with exclusive upper bounds and
+    ``centroid`` (z, y, x), both in voxels. ``edges`` lists pairs of touching
+    labels; statistics that come out of ``select`` have none.
+    """
+
+    def __init__(self, labels, voxels, mean, max, bbox, centroid, edges=None):
+        self.labels = labels
+        self.voxels = voxels
+        self.mean = mean
+        self.max = max
+        self.bbox = bbox
+        self.centroid = centroid
+        self.edges = np.empty((0, 2), dtype=np.int64) if edges is None else edges
+
+    def __len__(self):
+        return len(self.labels)
+
+    def take(self, index):
+        return LabelStats(self.labels[index], self.voxels[index], self.mean[index], self.max[index],
+                          self.bbox[index], self.centroid[index])
+
+    def merge(self, keep):
+        """Join the kept labels that touch into one entry each, labelled by their smallest label."""
+        roots = _components(self.edges, keep)
+        cells, group = np.unique(roots[keep], return_inverse=True)
+        n = len(cells)
+        weights = self.voxels[keep]
+        voxels = np.bincount(group, weights, minlength=n).astype(np.int64)
+        mean = np.bincount(group, self.mean[keep] * weights, minlength=n) / np.maximum(voxels, 1)
+        maxima = np.full(n, -np.inf)
+        np.maximum.at(maxima, group, self.max[keep])
+        bbox = np.empty((n, 6), dtype=self.bbox.dtype)
+        bbox[:, :3] = np.iinfo(self.bbox.dtype).max
+        bbox[:, 3:] = np.iinfo(self.bbox.dtype).min
+        np.minimum.at(bbox[:, :3], group, self.bbox[keep, :3])
+        np.maximum.at(bbox[:, 3:], group, self.bbox[keep, 3:])
+        centroid = np.stack([np.bincount(group, self.centroid[keep, axis] * weights, minlength=n)
+                             for axis in range(3)], axis=1) / np.maximum(voxels, 1)[:, None]
+        return LabelStats(cells, voxels, mean, maxima, bbox, centroid)
+
+    def select(self, at_least_vol, at_least_bright, threshold=None, merge=False):
+        """Labels that pass the filters: the cells of a counting run.
+
+        Labels need a mean intensity of at least ``at_least_bright``, a
+        brightest voxel of at least ``threshold`` and ``at_least_vol`` voxels.
+        With ``merge`` the bright labels that touch are joined first and the
+        volume filter applies to the joined cells.
+        """
+        keep = (self.voxels > 0) & (self.mean >= at_least_bright)
+        if threshold is not None:
+            keep &= self.max >= threshold
+        keep[0] = False
+        cells = self.merge(keep) if merge else self.take(keep)
+        return cells.take(cells.voxels >= at_least_vol)
+
+    def save(self, path):
+        tmp_path = temp_path(path)
+        np.savez(tmp_path, labels=self.labels, voxels=self.voxels, mean=self.mean, max=self.max, bbox=self.bbox,
+                 centroid=self.centroid, edges=self.edges)
+        publish(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as cached:
+            return cls(*(cached[name] for name in ('labels', 'voxels', 'mean', 'max', 'bbox', 'centroid', 'edges')))
+
+
+def label_stats(labels, volume, adjacency=True):
+    """``LabelStats`` of a (slice, row, col) label volume over the intensities in ``volume``."""
+    n_labels = max(int(np.max(labels[z0:z1])) for z0, z1 in _slabs(labels)) + 1 if len(labels) else 1
+    n_chunks = max(min(get_num_threads(), labels.shape[1], PARTIALS_BUDGET // (n_labels * PARTIAL_BYTES)), 1)
+    voxels = np.zeros((n_chunks, n_labels), dtype=np.int64)
+    sums = np.zeros((n_chunks, n_labels))
+    maxima = np.full((n_chunks, n_labels), -np.inf)
+    lower = np.full((n_chunks, n_labels, 3), np.iinfo(np.int64).max, dtype=np.int64)
+    upper = np.full((n_chunks, n_labels, 3), -1, dtype=np.int64)
+    coords = np.zeros((n_chunks, n_labels, 3))
+    pairs = Dict.empty(key_type=types.int64, value_type=types.int64)
+    for z0, z1 in _slabs(labels):
+        slab = np.ascontiguousarray(labels[z0:z1 + 1])
+        block = np.ascontiguousarray(volume[z0:z1])
+        with _parallel_lock:
+            _accumulate(slab[:z1 - z0], block, z0, voxels, sums, maxima, lower, upper, coords)
+        if adjacency:
+            _adjacency(slab, z1 - z0, n_labels, pairs)
+
+    voxels = voxels.sum(axis=0)
+    found = voxels > 0
+    maxima = np.where(found, maxima.max(axis=0), 0.0)
+    bbox = np.concatenate([lower.min(axis=0), upper.max(axis=0) + 1], axis=1)
+    bbox[~found] = 0
+    keys = _keys(pairs)
+    edges = np.stack([keys // n_labels, keys % n_labels], axis=1)
+    return LabelStats(np.arange(n_labels), voxels, sums.sum(axis=0) / np.maximum(voxels, 1), maxima, bbox,
+                      coords.sum(axis=0) / np.maximum(voxels, 1)[:, None], edges)
@@ -1,10 +1,61 @@
+import importlib
+import os
 import sys
+import threading
+import time
 from PyQt5.QtWidgets import QApplication
-from ui import VolumeRenderingApp
-from splash import show_splash_screen
+from splash import show_splash_screen, update_splash
+
+# Heavy modules imported in the background once the window is up, so their first use is fast
+PREWARM = os.environ.get('SENSE_PREWARM', '1') == '1'
+PREWARM_MODULES = ('matplotlib.backends.backend_qt5agg', 'skimage.segmentation', 'vtk', 'mayavi.mlab', 'sense_v2',
+                   'label_stats')
+
+def prewarm(modules=PREWARM_MODULES):
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+def start(app, splash=None):
+    """Build and show the main window, moving the splash on with every real step.
+
+    Returns the window and the seconds each step took.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def step(value, message):
+        if splash is not None:
+            update_splash(splash, value, message)
+        return time.perf_counter()
+
+    step_started = step(10, 'Loading interface')
+    from ui import VolumeRenderingApp
+    timings['import ui'] = time.perf_counter() - step_started
+
+    step_started = step(60, 'Building windows')
+    window = VolumeRenderingApp()
+    timings['build window'] = time.perf_counter() - step_started
+
+    step_started = step(100, 'Ready')
+    if splash is not None:
+        splash.finish(window)
+    window.show()
+    app.processEvents()
+    timings['show window'] = time.perf_counter() - step_started
+    timings['total'] = time.perf_counter() - started
+    return window, timings
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    mainWin = VolumeRenderingApp()
-    splash = show_splash_screen(mainWin)
+    splash = show_splash_screen()
+    mainWin, _ = start(app, splash)
+    if PREWARM:
+        prewarm()
     sys.exit(app.exec_())
@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from disk_cache import publish, temp_path
+from instrumentation import span
+
+LEVELS = (1, 2, 4, 8)
+
+
+def level_shape(shape, factor):
+    return tuple(size // factor for size in shape)
+
+
+def level_path(cache_dir, factor):
+    return os.path.join(cache_dir, f'gray_{factor}x.npy')
+
+
+def choose_level(shape, voxel_budget):
+    # Finest level whose voxel count fits the budget, the coarsest one otherwise
+    for factor in LEVELS:
+        if np.prod(level_shape(shape, factor), dtype=np.int64) <= voxel_budget:
+            return factor
+    return LEVELS[-1]
+
+
+def block_mean(volume, out, factor=2):
+    """Downsample a (slice, row, col) volume into ``out`` by averaging factor^3 blocks.
+
+    Works one output slice at a time, so only ``factor`` input slices are held
+    in memory. Trailing rows, columns and slices that do not fill a block are
+    dropped.
+    """
+    depth, rows, cols = out.shape
+    for z in range(depth):
+        slab = volume[z * factor:(z + 1) * factor, :rows * factor, :cols * factor]
+        blocks = slab.reshape(factor, rows, factor, cols, factor)
+        mean = blocks.sum(axis=(0, 2, 4), dtype=np.float32) / factor ** 3
+        out[z] = np.rint(mean) if np.issubdtype(out.dtype, np.integer) else mean
+    return out
+
+
+def load_level(volume, cache_dir, factor):
+    """Return pyramid level ``factor`` of ``volume``, building and caching it on first use.
+
+    Each level is reduced from the next finer cached level, so building the
+    8x level also leaves the 2x and 4x levels on disk.
+    """
+    if factor == 1:
+        return volume
+    if factor not in LEVELS:
+        raise ValueError(f'Unsupported pyramid level {factor}, expected one of {LEVELS}')
+    path = level_path(cache_dir, factor)
+    if not os.path.exists(path):
+        finer = load_level(volume, cache_dir, factor // 2)
+        tmp_path = temp_path(path)
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=volume.dtype,
+                                        shape=level_shape(volume.shape, factor))
+        with span('build pyramid level', 'rendering', factor=factor):
+            block_mean(finer, out)
+        out.flush()
+        del out
+        publish(tmp_path, path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,181 @@
+"""Counting runs and the measurements of every counted cell, in one indexed SQLite file.
+
+Usage: python results_store.py runs [--directory DIR] [--db results.sqlite]
+       python results_store.py export cells.csv [--run 12 13] [--directory DIR]
+
+Each run is a row of ``runs`` holding the stack, every counting parameter as
+its own column, the stage timings and the cell count. Each cell of a run
+counted with the staged pipeline is a row of ``cells``: label id, voxel
+count, mean and max intensity, centroid and bounding box, in voxels of the
+counted volume (slices resized to ``width`` x ``height``). Runs are appended
+in one transaction per batch and queries filter in SQL on indexed columns, so
+they read only the rows they return and never touch the stacks themselves.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+from datetime import datetime, timezone
+
+from counting import DEFAULT_PARAMS, PARAM_NAMES
+
+RESULTS_PATH = os.environ.get('SENSE_RESULTS', os.path.join(os.path.expanduser('~'), 'sense_results.sqlite'))
+CELL_COLUMNS = ('label', 'voxels', 'mean_intensity', 'max_intensity', 'z', 'y', 'x',
+                'z0', 'y0', 'x0', 'z1', 'y1', 'x1')
+SQL_TYPES = {int: 'INTEGER', float: 'REAL', str: 'TEXT'}
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    created TEXT NOT NULL,
+    host TEXT,
+    directory TEXT NOT NULL,
+    backend TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    num_cells INTEGER,
+    seconds REAL,
+    {params},
+    filename_template TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_directory ON runs (directory, created);
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+CREATE TABLE IF NOT EXISTS cells (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    label INTEGER NOT NULL,
+    voxels INTEGER NOT NULL,
+    mean_intensity REAL,
+    max_intensity REAL,
+    z REAL, y REAL, x REAL,
+    z0 INTEGER, y0 INTEGER, x0 INTEGER, z1 INTEGER, y1 INTEGER, x1 INTEGER,
+    PRIMARY KEY (run_id, label)
+) WITHOUT ROWID;
+'''.format(params=',\n    '.join(f'{name} {SQL_TYPES[type(DEFAULT_PARAMS[name])]}' for name in PARAM_NAMES))
+RUN_COLUMNS = ('created', 'host', 'directory', 'backend', 'status', 'error', 'num_cells', 'seconds') + PARAM_NAMES + (
+    'filename_template', 'timings')
+
+
+def cell_rows(run_id, cells):
+    # One tuple per cell of a ``LabelStats``, in CELL_COLUMNS order
+    columns = [cells.labels, cells.voxels, cells.mean, cells.max, *cells.centroid.T, *cells.bbox.T]
+    return [(run_id,) + row for row in zip(*(column.tolist() for column in columns))]
+
+
+class ResultsStore:
+    """Append-only store of counting runs; the file is created on first use.
+
+    ``add_runs`` takes dicts with ``directory``, ``params`` and ``num_cells``
+    and optionally ``status``, ``error``, ``seconds``, ``timings``,
+    ``backend`` and ``cells`` (a ``LabelStats``).
+    """
+
+    def __init__(self, path=RESULTS_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        # WAL lets the GUI and batch runs read while another process appends
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, directory, params, num_cells, **run):
+        return self.add_runs([dict(run, directory=directory, params=params, num_cells=num_cells)])[0]
+
+    def add_runs(self, runs):
+        """Append ``runs`` in one transaction and return their run ids."""
+        created = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        placeholders = ', '.join('?' * len(RUN_COLUMNS))
+        run_ids = []
+        with self.connection:
+            for run in runs:
+                params = run['params']
+                row = (created, platform.node(), os.path.abspath(run['directory']), run.get('backend'),
+                       run.get('status', 'ok'), run.get('error') or None, run['num_cells'], run.get('seconds'))
+                row += tuple(params.get(name) for name in PARAM_NAMES)
+                row += (params.get('filename_template'), json.dumps(run.get('timings') or {}))
+                cursor = self.connection.execute(f'INSERT INTO runs ({", ".join(RUN_COLUMNS)}) VALUES ({placeholders})',
+                                                 row)
+                run_ids.append(cursor.lastrowid)
+                if run.get('cells') is not None:
+                    self.connection.executemany(
+                        f'INSERT INTO cells (run_id, {", ".join(CELL_COLUMNS)}) VALUES (?{", ?" * len(CELL_COLUMNS)})',
+                        cell_rows(cursor.lastrowid, run['cells']))
+        return run_ids
+
+    def _where(self, run_ids=None, directory=None, params=None):
+        clauses, values = [], []
+        if run_ids is not None:
+            run_ids = list(run_ids)
+            clauses.append(f'runs.run_id IN ({", ".join("?" * len(run_ids))})')
+            values.extend(run_ids)
+        if directory is not None:
+            clauses.append('runs.directory = ?')
+            values.append(os.path.abspath(directory))
+        for name, value in (params or {}).items():
+            if name not in PARAM_NAMES + ('filename_template', 'backend', 'status'):
+                raise ValueError(f'Unknown run column {name!r}')
+            clauses.append(f'runs.{name} = ?')
+            values.append(value)
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), values
+
+    def runs(self, run_ids=None, directory=None, **params):
+        """Runs as a pandas DataFrame, optionally filtered by run id, stack and column values."""
+        import pandas as pd
+
+        where, values = self._where(run_ids, directory, params)
+        return pd.read_sql_query(f'SELECT * FROM runs{where} ORDER BY run_id', self.connection, params=values)
+
+    def cells(self, run_ids=None, directory=None, **params):
+        """Cells of the selected runs as a pandas DataFrame, with the stack each came from."""
+        import pandas as pd
+
+        where, values = self._where(run_ids, directory, params)
+        return pd.read_sql_query(f'SELECT cells.*, runs.directory FROM cells JOIN runs USING (run_id){where} '
+                                 'ORDER BY run_id, label', self.connection, params=values)
+
+    def export_cells(self, path, run_ids=None, directory=None, **params):
+        """Write the selected cells to .csv, .parquet or .feather (the latter two need pyarrow)."""
+        cells = self.cells(run_ids, directory, **params)
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.parquet':
+            cells.to_parquet(path, index=False)
+        elif extension == '.feather':
+            cells.to_feather(path)
+        else:
+            cells.to_csv(path, index=False)
+        return len(cells)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query and export stored cell counting results.')
+    parser.add_argument('--db', default=RESULTS_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    runs = subparsers.add_parser('runs', help='list the stored runs')
+    runs.add_argument('--directory', default=None)
+    export = subparsers.add_parser('export', help='write per-cell measurements to .csv, .parquet or .feather')
+    export.add_argument('out')
+    export.add_argument('--run', dest='run_ids', type=int, nargs='+', default=None)
+    export.add_argument('--directory', default=None)
+    args = parser.parse_args(argv)
+
+    with ResultsStore(args.db) as store:
+        if args.command == 'runs':
+            columns = ['run_id', 'created', 'directory', 'backend', 'status', 'num_cells', 'seconds']
+            print(store.runs(directory=args.directory)[columns].to_string(index=False))
+        else:
+            count = store.export_cells(args.out, args.run_ids, args.directory)
+            print(f'Exported {count} cells to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
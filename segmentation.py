@@ -0,0 +1,232 @@
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import product
+import numpy as np
+from instrumentation import span
+
+SLIC_MEMORY_BUDGET = int(os.environ.get('SENSE_SLIC_MEMORY_MB', 2048)) * 2**20
+SLIC_WORKERS = int(os.environ.get('SENSE_SLIC_WORKERS', 0)) or os.cpu_count() or 1
+# Working memory of skimage's SLIC per voxel: float64 image, distances and labels plus the input slab
+SLIC_BYTES_PER_VOXEL = 48
+
+
+def slic(volume, n_segments, compactness, mask=None):
+    from skimage.segmentation import slic as skimage_slic
+
+    if mask is not None:
+        foreground = int(np.count_nonzero(mask))
+        if not foreground:
+            return np.zeros(volume.shape, dtype=np.int32)
+        # skimage seeds a masked SLIC with k-means++ over every foreground voxel, which costs foreground voxels
+        # times segments and does not finish at the default 25000 supervoxels. Seeding on the regular grid and
+        # clearing the background afterwards stays linear; the grid gets more segments so the foreground keeps
+        # ``n_segments`` of them.
+        n_segments = min(n_segments * mask.size / foreground, foreground)
+    labels = skimage_slic(np.asarray(volume), n_segments=max(int(n_segments), 1), compactness=compactness,
+                          channel_axis=None, start_label=1).astype(np.int32, copy=False)
+    if mask is not None:
+        labels[~mask] = 0
+    return labels
+
+
+def supervoxel_step(shape, n_segments):
+    return math.ceil((np.prod(shape, dtype=np.float64) / max(n_segments, 1)) ** (1 / 3))
+
+
+def plan_tiles(shape, n_segments, memory_budget=SLIC_MEMORY_BUDGET, halo=None):
+    """Split a (slice, row, col) volume into overlapping tiles that fit the memory budget.
+
+    Returns ``(core, padded)`` slice tuples per tile; cores partition the volume
+    and each padded box extends its core by ``halo`` voxels (one supervoxel
+    step by default). A volume that fits the budget is a single tile.
+    """
+    halo = supervoxel_step(shape, n_segments) if halo is None else halo
+    tile_budget = memory_budget // SLIC_BYTES_PER_VOXEL
+    counts = [1, 1, 1]
+    while True:
+        tile = [math.ceil(size / count) for size, count in zip(shape, counts)]
+        padded = [min(size, t + 2 * halo) for size, t in zip(shape, tile)]
+        if np.prod(padded, dtype=np.int64) <= tile_budget or all(t <= 2 * halo for t in tile):
+            break
+        # Halve the longest tile edge first, keeping tiles roughly cubic
+        axis = int(np.argmax(tile))
+        counts[axis] *= 2
+
+    tiles = []
+    bounds = [np.linspace(0, size, count + 1).astype(int) for size, count in zip(shape, counts)]
+    for index in product(*(range(count) for count in counts)):
+        core = tuple(slice(bounds[axis][i], bounds[axis][i + 1]) for axis, i in enumerate(index))
+        if any(s.start == s.stop for s in core):
+            continue
+        padded = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, size)) for s, size in zip(core, shape))
+        tiles.append((core, padded))
+    return tiles
+
+
+def _shift(region, origin):
+    return tuple(slice(s.start - o, s.stop - o) for s, o in zip(region, origin))
+
+
+def _overlaps(a, b):
+    return all(s.start < t.stop and t.start < s.stop for s, t in zip(a, b))
+
+
+def _crop(labels, region):
+    # The part of ``labels`` (covering ``region``) that holds labels, with its region; None when it holds none
+    boxes = []
+    for axis in range(3):
+        used = np.flatnonzero(labels.any(axis=tuple(a for a in range(3) if a != axis)))
+        if not len(used):
+            return None
+        boxes.append(slice(used[0], used[-1] + 1))
+    return tuple(slice(s.start + b.start, s.start + b.stop) for s, b in zip(region, boxes)), labels[tuple(boxes)]
+
+
+def _apply_overhang(out, region, labels):
+    current = np.asarray(out[region])
+    free = (current == 0) & (labels > 0)
+    current[free] = labels[free]
+    out[region] = current
+
+
+def _grow(labels, holes):
+    # One 6-connected step: every hole next to a label takes it, neighbours tried in a fixed order
+    grown = np.zeros_like(labels)
+    for axis in range(3):
+        for step in (1, -1):
+            source = [slice(None)] * 3
+            target = [slice(None)] * 3
+            source[axis], target[axis] = (slice(1, None), slice(None, -1)) if step == 1 else \
+                (slice(None, -1), slice(1, None))
+            view = grown[tuple(target)]
+            empty = view == 0
+            view[empty] = labels[tuple(source)][empty]
+    grown[~holes] = 0
+    return grown
+
+
+def _fill_holes(out, volume, threshold, core, padded, next_label):
+    """Label the foreground voxels of ``core`` that no tile kept.
+
+    A supervoxel is dropped by every tile whose core does not hold its
+    centroid, and the tile that owns it segmented the area differently, so
+    parts of it can stay unlabelled. Those voxels join the labels they touch,
+    growing through the foreground only; pieces that touch no label become
+    supervoxels of their own, numbered from ``next_label``. Returns the next
+    free label.
+    """
+    from scipy import ndimage
+
+    region = np.asarray(out[padded]).copy()
+    inner = _shift(core, [s.start for s in padded])
+    inside = np.zeros(region.shape, dtype=bool)
+    inside[inner] = True
+    holes = inside & (region == 0)
+    if threshold is not None:
+        holes &= np.asarray(volume[padded]) >= threshold
+    if not holes.any():
+        return next_label
+    while True:
+        grown = _grow(region, holes)
+        filled = grown > 0
+        if not filled.any():
+            break
+        region[filled] = grown[filled]
+        holes &= ~filled
+    if holes.any():
+        pieces, count = ndimage.label(holes)
+        region[holes] = pieces[holes] + (next_label - 1)
+        next_label += count
+    out[core] = region[inner]
+    return next_label
+
+
+def tiled_slic(volume, n_segments, compactness, threshold=None, memory_budget=SLIC_MEMORY_BUDGET,
+               workers=SLIC_WORKERS, out=None, progress=None):
+    """Supervoxel labels of ``volume`` computed on overlapping tiles in parallel.
+
+    Every tile is segmented together with its halo and keeps only the
+    supervoxels whose centroid lies in its core, so a supervoxel crossing a
+    tile boundary is labelled (and later counted) by exactly one tile. Kept
+    supervoxels are written inside the core first; their parts reaching into a
+    neighbouring core fill only voxels that neighbour left unlabelled, and
+    foreground voxels still unlabelled after that join an adjacent label.
+    Overhangs are applied in tile order as soon as the neighbours they reach
+    into are done, so only those of tiles still waiting are held in memory.
+    Voxels below ``threshold`` stay 0. Tiles are sized from the whole
+    ``memory_budget`` and only as many run at once as fit in it. ``out`` may
+    be an int32 memmap for volumes whose labels do not fit in RAM.
+    """
+    shape = volume.shape
+    if out is None:
+        out = np.zeros(shape, dtype=np.int32)
+    total_voxels = np.prod(shape, dtype=np.float64)
+    # Supervoxels are spread evenly over the foreground of the whole volume; each tile gets its share of them
+    foreground = total_voxels if threshold is None else \
+        float(sum(np.count_nonzero(np.asarray(image) >= threshold) for image in volume))
+    if not foreground:
+        return out
+    tiles = plan_tiles(shape, n_segments * total_voxels / foreground, memory_budget)
+    largest = max(np.prod([s.stop - s.start for s in padded], dtype=np.int64) for _, padded in tiles)
+    workers = max(min(workers, len(tiles), memory_budget // (largest * SLIC_BYTES_PER_VOXEL)), 1)
+    lock = threading.Lock()
+    next_label = [1]
+    # Tiles whose cores an overhang can reach into; it is applied once all of them have written their cores
+    reaches = [[j for j, (other, _) in enumerate(tiles) if _overlaps(other, padded)] for _, padded in tiles]
+    overhangs = {}
+    finished = set()
+    applied = 0
+
+    def segment(core, padded):
+        with span('read tile', 'SLIC'):
+            block = np.asarray(volume[padded])
+        mask = block >= threshold if threshold is not None else None
+        with span('SLIC tile', 'SLIC', voxels=int(block.size)):
+            share = (block.size if mask is None else np.count_nonzero(mask)) / foreground
+            local = slic(block, n_segments * share, compactness, mask)
+        voxels = np.bincount(local.ravel())
+        owned = voxels > 0
+        owned[0] = False
+        for axis, (c, p) in enumerate(zip(core, padded)):
+            coordinate = np.arange(p.start, p.stop).reshape([-1 if a == axis else 1 for a in range(3)])
+            centroid = np.bincount(local.ravel(), np.broadcast_to(coordinate, local.shape).ravel(),
+                                   minlength=len(voxels)) / np.maximum(voxels, 1)
+            owned &= (centroid >= c.start) & (centroid < c.stop)
+        kept = np.flatnonzero(owned)
+        with lock:
+            offset = next_label[0]
+            next_label[0] += len(kept)
+        lut = np.zeros(len(voxels), dtype=np.int32)
+        lut[kept] = offset + np.arange(len(kept))
+        labels = lut[local]
+        origin = [s.start for s in padded]
+        out[core] = labels[_shift(core, origin)]
+        labels[_shift(core, origin)] = 0
+        return _crop(labels, padded)
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(segment, core, padded): index for index, (core, padded) in enumerate(tiles)}
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                index = futures.pop(future)
+                overhangs[index] = future.result()
+                finished.add(index)
+                # In tile order, so the labelling does not depend on which tile finished first; the cores an
+                # overhang reaches into are never written again, so running tiles do not touch its region
+                while applied < len(tiles) and finished.issuperset(reaches[applied]):
+                    overhang = overhangs.pop(applied)
+                    if overhang is not None:
+                        _apply_overhang(out, *overhang)
+                    applied += 1
+                if progress is not None:
+                    progress(done / len(tiles))
+        except BaseException:
+            # A cancelled run only waits for the tiles already being segmented
+            executor.shutdown(cancel_futures=True)
+            raise
+    with span('fill tile seams', 'SLIC'):
+        for core, padded in tiles:
+            next_label[0] = _fill_holes(out, volume, threshold, core, padded, next_label[0])
+    return out
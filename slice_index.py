@@ -0,0 +1,254 @@
+"""Slice index of a stack directory: which files form the stack and in which Z order.
+
+Slices are ordered by the Z index parsed with a filename template such as
+``HepaRG_n1 P3 D7_1000_4_C001Z{:03d}.tif`` or, when no file matches it, by
+natural sort (``Z2`` before ``Z10``). Image headers are read without decoding
+the pixels to find gaps, duplicate Z indices and slices whose shape or dtype
+differs from the rest. Manifests are cached in memory per directory and the
+header of every file on disk, so reindexing an unchanged directory costs one
+``stat`` and a directory with new files only reads the new headers.
+"""
+import hashlib
+import json
+import os
+import re
+import string
+import struct
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from disk_cache import publish, temp_path
+
+SLICE_EXTENSIONS = ('.tif', '.tiff')
+DEFAULT_TEMPLATE = 'HepaRG_n1 P3 D7_1000_4_C001Z{:03d}.tif'
+HEADER_WORKERS = 8
+
+_manifests = {}
+_lock = threading.Lock()
+
+# TIFF tags read from the first IFD and the field types they may use
+TIFF_WIDTH, TIFF_HEIGHT, TIFF_BITS, TIFF_SAMPLES, TIFF_SAMPLE_FORMAT = 256, 257, 258, 277, 339
+TIFF_TYPES = {3: ('H', 2), 4: ('I', 4), 16: ('Q', 8)}
+TIFF_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def natural_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def template_pattern(template):
+    """Regex for a ``str.format`` filename template; the last replacement field is the Z index."""
+    parts = list(string.Formatter().parse(template))
+    fields = sum(field is not None for _, field, _, _ in parts)
+    if not fields:
+        raise ValueError(f'Filename template {template!r} has no {{}} field for the Z index')
+    pattern, seen = '', 0
+    for literal, field, _, _ in parts:
+        pattern += re.escape(literal)
+        if field is not None:
+            seen += 1
+            pattern += r'(\d+)' if seen == fields else '.+?'
+    return re.compile(pattern + '$')
+
+
+def _read_tiff_header(path):
+    # (shape, dtype) from the first IFD, reading a few hundred bytes instead of the whole image
+    with open(path, 'rb') as f:
+        head = f.read(16)
+        order = {b'II': '<', b'MM': '>'}.get(head[:2])
+        if order is None:
+            raise ValueError('not a TIFF file')
+        version = struct.unpack(order + 'H', head[2:4])[0]
+        if version == 42:
+            offset_format, count_format = 'I', 'H'
+            offset = struct.unpack(order + 'I', head[4:8])[0]
+        elif version == 43:
+            offset_format, count_format = 'Q', 'Q'
+            offset = struct.unpack(order + 'Q', head[8:16])[0]
+        else:
+            raise ValueError(f'unknown TIFF version {version}')
+        value_size = struct.calcsize(offset_format)
+        entry_size = 4 + 2 * value_size
+        f.seek(offset)
+        count_size = struct.calcsize(count_format)
+        n_entries = struct.unpack(order + count_format, f.read(count_size))[0]
+        entries = f.read(n_entries * entry_size)
+        tags = {}
+        for i in range(n_entries):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type = struct.unpack(order + 'HH', entry[:4])
+            if field_type not in TIFF_TYPES or tag not in (TIFF_WIDTH, TIFF_HEIGHT, TIFF_BITS, TIFF_SAMPLES,
+                                                           TIFF_SAMPLE_FORMAT):
+                continue
+            fmt, size = TIFF_TYPES[field_type]
+            count = struct.unpack(order + offset_format, entry[4:4 + value_size])[0]
+            data = entry[4 + value_size:]
+            if count * size > value_size:
+                f.seek(struct.unpack(order + offset_format, data)[0])
+                data = f.read(count * size)
+            tags[tag] = struct.unpack(order + fmt * count, data[:count * size])
+    bits = tags.get(TIFF_BITS, (1,))[0]
+    samples = tags.get(TIFF_SAMPLES, (1,))[0]
+    dtype = np.dtype(f'{TIFF_KINDS.get(tags.get(TIFF_SAMPLE_FORMAT, (1,))[0], "u")}{max(bits // 8, 1)}')
+    shape = (tags[TIFF_HEIGHT][0], tags[TIFF_WIDTH][0]) + ((samples,) if samples > 1 else ())
+    return shape, str(dtype)
+
+
+def read_header(path):
+    try:
+        return _read_tiff_header(path)
+    except (OSError, KeyError, ValueError, TypeError, struct.error):
+        # Not a plain TIFF (or a broken header); fall back to decoding the image
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return None, None
+        return img.shape, str(img.dtype)
+
+
+class SliceManifest:
+    """Ordered slices of a directory together with what validating them found.
+
+    ``names`` and ``z`` are in stack order. ``issues`` lists gaps, duplicates
+    and dropped files as readable messages; ``mismatched`` names the slices
+    whose shape or dtype differs from the majority, which ``check()`` rejects.
+    """
+
+    def __init__(self, directory, template, entries, mtime_ns):
+        self.directory = directory
+        self.template = template
+        self.entries = entries
+        self.mtime_ns = mtime_ns
+        self.issues = []
+        # Names that sort equal naturally (s1, s01) fall back to plain order, never to the directory listing's
+        names = sorted(entries, key=lambda name: (natural_key(name), name))
+
+        self.ordering = 'natural'
+        numbers = None
+        if template:
+            pattern = template_pattern(template)
+            matches = {name: pattern.match(name) for name in names}
+            matched = [name for name in names if matches[name]]
+            if matched:
+                self.ordering = 'template'
+                if len(matched) < len(names):
+                    self.issues.append(f'{len(names) - len(matched)} files do not match {template!r} and are ignored')
+                names = matched
+                numbers = [int(matches[name].group(1)) for name in names]
+            else:
+                self.issues.append(f'No file matches {template!r}, slices are in natural sort order')
+        if numbers is None:
+            # Natural sort takes the last number in the file name as the Z index when every file has one
+            trailing = [re.findall(r'\d+', os.path.splitext(name)[0]) for name in names]
+            numbers = [int(found[-1]) for found in trailing] if all(trailing) else list(range(len(names)))
+        order = sorted(range(len(names)), key=lambda i: (numbers[i], natural_key(names[i]), names[i]))
+
+        self.names, self.z = [], []
+        for i in order:
+            if self.z and numbers[i] == self.z[-1]:
+                self.issues.append(f'Z {numbers[i]}: {names[i]} duplicates {self.names[-1]} and is ignored')
+                continue
+            self.names.append(names[i])
+            self.z.append(numbers[i])
+        missing = sorted(set(range(self.z[0], self.z[-1] + 1)) - set(self.z)) if self.z else []
+        if missing:
+            self.issues.append(f'{len(missing)} Z indices are missing: {_ranges(missing)}')
+
+        headers = Counter((tuple(entries[name][2] or ()), entries[name][3]) for name in self.names)
+        (shape, dtype), _ = headers.most_common(1)[0] if headers else (((), None), 0)
+        self.shape, self.dtype = shape, dtype
+        self.mismatched = [name for name in self.names
+                           if (tuple(entries[name][2] or ()), entries[name][3]) != (shape, dtype)]
+        for name in self.mismatched:
+            found = tuple(entries[name][2] or ()), entries[name][3]
+            self.issues.append(f'{name} is {found[0]} {found[1]}, expected {shape} {dtype}'
+                               if found[1] else f'{name} is not a readable image')
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def paths(self):
+        return [os.path.join(self.directory, name) for name in self.names]
+
+    def check(self):
+        if self.mismatched:
+            raise ValueError(f'{len(self.mismatched)} slices in {self.directory} differ in shape or dtype: '
+                             + ', '.join(self.mismatched[:5]))
+        return self
+
+
+def _ranges(values):
+    runs = []
+    for value in values:
+        if runs and value == runs[-1][1] + 1:
+            runs[-1][1] = value
+        else:
+            runs.append([value, value])
+    return ', '.join(str(a) if a == b else f'{a}-{b}' for a, b in runs)
+
+
+def _cache_path(cache_dir, directory):
+    return os.path.join(cache_dir, hashlib.sha1(directory.encode()).hexdigest() + '.json')
+
+
+def _read_cached_entries(cache_dir, directory):
+    try:
+        with open(_cache_path(cache_dir, directory)) as f:
+            cached = json.load(f)
+        if cached['directory'] == directory:
+            return cached['entries']
+    except (OSError, KeyError, ValueError):
+        pass
+    return {}
+
+
+def _write_cached_entries(cache_dir, directory, entries):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _cache_path(cache_dir, directory)
+        tmp_path = temp_path(path)
+        with open(tmp_path, 'w') as f:
+            json.dump({'directory': directory, 'entries': entries}, f)
+        publish(tmp_path, path)
+    except OSError:
+        pass
+
+
+def index_slices(directory, template=None, cache_dir=None):
+    """Manifest of the slices in ``directory``, reusing the cached one while the directory is unchanged."""
+    directory = os.path.abspath(directory)
+    mtime_ns = os.stat(directory).st_mtime_ns
+    with _lock:
+        manifest = _manifests.get((directory, template))
+        if manifest is not None and manifest.mtime_ns == mtime_ns:
+            return manifest
+        previous = next((m.entries for (d, _), m in _manifests.items() if d == directory), None)
+
+    if previous is None and cache_dir is not None:
+        previous = _read_cached_entries(cache_dir, directory)
+    previous = previous or {}
+    with os.scandir(directory) as it:
+        files = [(entry.name, entry.stat()) for entry in it
+                 if entry.is_file() and entry.name.lower().endswith(SLICE_EXTENSIONS)]
+    # Headers are reused per file while its size and mtime are unchanged
+    entries, stale = {}, []
+    for name, stat in files:
+        old = previous.get(name)
+        if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+            entries[name] = old
+        else:
+            stale.append((name, stat))
+    if stale:
+        with ThreadPoolExecutor(HEADER_WORKERS) as executor:
+            headers = executor.map(lambda item: read_header(os.path.join(directory, item[0])), stale)
+            for (name, stat), (shape, dtype) in zip(stale, headers):
+                entries[name] = [stat.st_size, stat.st_mtime_ns, list(shape) if shape else None, dtype]
+    if cache_dir is not None and (stale or len(entries) != len(previous)):
+        _write_cached_entries(cache_dir, directory, entries)
+
+    manifest = SliceManifest(directory, template, entries, mtime_ns)
+    with _lock:
+        _manifests[(directory, template)] = manifest
+    return manifest
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+from disk_cache import publish, temp_path
+
+SIDECAR_NAME = '.sense_stats.npz'
+REFER_TYPES = ('mean', 'median', 'larger100')
+
+
+def slice_histogram(image_gray):
+    return np.bincount(image_gray.ravel(), minlength=256)
+
+
+class SliceStats:
+    """Per-slice brightness statistics derived from 256-bin slice histograms.
+
+    Background (zero) pixels are excluded from the mean and the median, as the
+    reference-slice choice has always done.
+    """
+
+    def __init__(self, hist):
+        self.hist = np.asarray(hist, dtype=np.int64)
+        foreground = self.hist[:, 1:]
+        counts = foreground.sum(axis=1)
+        values = np.arange(1, 256)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean = (foreground @ values) / counts
+        # The median is the mean of the two middle foreground values, read off the cumulative histogram
+        cdf = np.cumsum(foreground, axis=1)
+        lower = np.array([np.searchsorted(c, (n - 1) // 2, side='right') for c, n in zip(cdf, counts)]) + 1
+        upper = np.array([np.searchsorted(c, n // 2, side='right') for c, n in zip(cdf, counts)]) + 1
+        self.median = np.where(counts > 0, (lower + upper) / 2, np.nan)
+        self.larger_100 = self.hist[:, 100:].sum(axis=1)
+
+    def __len__(self):
+        return len(self.hist)
+
+    def reference_index(self, refer_type):
+        if refer_type == 'mean':
+            return int(np.nanargmax(self.mean))
+        if refer_type == 'median':
+            return int(np.nanargmax(self.median))
+        if refer_type == 'larger100':
+            return int(np.argmax(self.larger_100))
+        raise ValueError(f'Unknown reference type {refer_type!r}, expected one of {REFER_TYPES}')
+
+
+def load_sidecar(key, *directories):
+    for directory in directories:
+        path = os.path.join(directory, SIDECAR_NAME)
+        try:
+            with np.load(path) as sidecar:
+                if str(sidecar['key']) == key:
+                    return SliceStats(sidecar['hist'])
+        except (OSError, KeyError, ValueError):
+            continue
+    return None
+
+
+def save_sidecar(stats, key, *directories):
+    # Written next to the stack when possible, otherwise into the first writable fallback directory
+    for directory in directories:
+        path = os.path.join(directory, SIDECAR_NAME)
+        tmp_path = temp_path(path)
+        try:
+            np.savez(tmp_path, key=key, hist=stats.hist)
+            publish(tmp_path, path)
+            return path
+        except OSError:
+            continue
+    return None
@@ -1,8 +1,8 @@
-from PyQt5.QtWidgets import QSplashScreen, QProgressBar, QDesktopWidget
+from PyQt5.QtWidgets import QApplication, QSplashScreen, QProgressBar, QDesktopWidget
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtCore import Qt
 
-def show_splash_screen(mainWin):
+def show_splash_screen():
     splash_pix = QPixmap('splash.png')
     splash_pix = splash_pix.scaled(splash_pix.width() // 2, splash_pix.height() // 2, Qt.KeepAspectRatio)
     splash = QSplashScreen(splash_pix, Qt.WindowStaysOnTopHint)
@@ -24,19 +24,14 @@ def show_splash_screen(mainWin):
         }
     """)
     progressBar.setGeometry(46, splash_pix.height() - 260, splash_pix.width() - 510, 20)
+    splash.progressBar = progressBar
     splash.show()
-
-    def update_progress():
-        value = progressBar.value()
-        if value < 100:
-            progressBar.setValue(value + 1)
-        else:
-            progressTimer.stop()
-            splash.close()
-            mainWin.show()
-
-    progressTimer = QTimer()
-    progressTimer.timeout.connect(update_progress)
-    progressTimer.start(50)
-
+    QApplication.processEvents()
     return splash
+
+def update_splash(splash, value, message=''):
+    # Startup runs on the GUI thread, so the splash is repainted explicitly after every step
+    splash.progressBar.setValue(value)
+    if message:
+        splash.showMessage(message, Qt.AlignBottom | Qt.AlignHCenter)
+    QApplication.processEvents()
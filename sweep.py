@@ -0,0 +1,171 @@
+"""Parameter sweeps for cell counting that reuse every stage a grid point shares.
+
+Usage: python sweep.py STACK_DIR --compactness 20:80:20 --at-least-bright 5,10,20 --out sweep.csv
+
+Values are comma separated lists or inclusive start:stop:step ranges. With the
+staged backend the matched volume is computed once per reference type and
+slice size, SLIC once per supervoxel count, compactness and threshold, and the
+brightness and volume filters are re-applied per grid point from the cached
+supervoxel statistics. The sense backend runs every grid point in full.
+"""
+import argparse
+import csv
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from counting import (BACKENDS, COUNTING_BACKEND, DEFAULT_PARAMS, PARAM_NAMES, CountingProgress,
+                      count_in_subprocess, filter_supervoxels, matched_volume, supervoxels)
+from segmentation import SLIC_MEMORY_BUDGET, SLIC_WORKERS
+from volume_store import open_store
+
+SWEEP_WORKERS = 2
+# Parameters each cached stage depends on
+MATCH_PARAMS = ('refer_type', 'width', 'height')
+SLIC_PARAMS = MATCH_PARAMS + ('numOfSupervoxel', 'compactness', 'threshold')
+
+
+def parse_values(text, kind=int):
+    if ':' in text:
+        parts = text.split(':')
+        if len(parts) != 3:
+            raise ValueError(f'Range {text!r} must be start:stop:step')
+        start, stop, step = (kind(value) for value in parts)
+        if step == 0:
+            raise ValueError(f'Range {text!r} has a step of 0')
+        count = int((stop - start) / step + 1e-9) + 1 if (stop - start) / step >= 0 else 0
+        return [start + i * step for i in range(count)]
+    return [kind(value) for value in text.split(',') if value.strip()]
+
+
+def expand_grid(base_params, grid):
+    names = list(grid)
+    return [dict(base_params, **dict(zip(names, values))) for values in itertools.product(*grid.values())]
+
+
+def _key(params, names):
+    return tuple(params[name] for name in names)
+
+
+def run_sweep(directory, base_params, grid, workers=SWEEP_WORKERS, progress=None, backend=None):
+    """Cell count for every point of ``grid`` (parameter name -> list of values).
+
+    Returns one row per grid point with all counting parameters and
+    ``num_cells``. ``progress`` is a ``CountingProgress`` whose callback gets
+    the fraction of SLIC groups (or grid points) done; cancelling it stops the
+    sweep.
+    """
+    progress = progress or CountingProgress()
+    points = expand_grid(dict(base_params, image_path=directory), grid)
+    if (backend or COUNTING_BACKEND) != 'staged':
+        return _run_full(points, workers, progress)
+
+    store = open_store(directory, base_params.get('filename_template'))
+    groups = {}
+    for params in points:
+        groups.setdefault(_key(params, SLIC_PARAMS), []).append(params)
+    matched = {}
+    for params in points:
+        key = _key(params, MATCH_PARAMS)
+        if key not in matched:
+            matched[key] = matched_volume(store, params, CountingProgress(cancel_event=progress.cancel_event))
+
+    def run_group(group):
+        params = group[0]
+        stats = supervoxels(store, matched[_key(params, MATCH_PARAMS)], params,
+                            CountingProgress(cancel_event=progress.cancel_event), SLIC_MEMORY_BUDGET,
+                            max(SLIC_WORKERS // workers, 1))
+        return [dict(point, num_cells=len(filter_supervoxels(stats, point))) for point in group]
+
+    rows = []
+    # Grid points sharing SLIC parameters form one group; independent groups run concurrently
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_group, group) for group in groups.values()]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                rows.extend(future.result())
+                progress.check()
+                if progress.callback is not None:
+                    progress.callback(done / len(futures), f'Sweep: {done}/{len(futures)} SLIC runs done')
+        except BaseException:
+            progress.cancel()
+            executor.shutdown(cancel_futures=True)
+            raise
+    return sorted(rows, key=lambda row: [row[name] for name in grid])
+
+
+def _run_full(points, workers, progress):
+    def run_point(params):
+        num_cells = count_in_subprocess(params, CountingProgress(cancel_event=progress.cancel_event),
+                                        params['image_path'], backend='sense')
+        return dict(params, num_cells=num_cells)
+
+    rows = []
+    # Every grid point counts in a spawned child like a GUI run: forking the GUI process with its Qt and
+    # loader threads can deadlock, and a cancelled child is terminated after CANCEL_GRACE seconds
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_point, params) for params in points]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                rows.append(future.result())
+                progress.check()
+                if progress.callback is not None:
+                    progress.callback(done / len(futures), f'Sweep: {done}/{len(futures)} grid points done')
+        except BaseException:
+            progress.cancel()
+            executor.shutdown(cancel_futures=True)
+            raise
+    return rows
+
+
+def write_csv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, PARAM_NAMES + ('num_cells',), extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def pivot(rows, row_param, col_param):
+    # Cell counts as a 2D table over two swept parameters, for a heatmap
+    row_values = sorted({row[row_param] for row in rows})
+    col_values = sorted({row[col_param] for row in rows})
+    table = [[None] * len(col_values) for _ in row_values]
+    for row in rows:
+        table[row_values.index(row[row_param])][col_values.index(row[col_param])] = row['num_cells']
+    return row_values, col_values, table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep cell counting parameters over one stack.')
+    parser.add_argument('directory')
+    parser.add_argument('--out', default='sweep.csv')
+    parser.add_argument('--workers', type=int, default=SWEEP_WORKERS)
+    parser.add_argument('--backend', choices=BACKENDS, default='staged')
+    options = (('--refer-type', 'refer_type', str), ('--supervoxels', 'numOfSupervoxel', int),
+               ('--compactness', 'compactness', int), ('--at-least-bright', 'atLeastBright', int),
+               ('--at-least-vol', 'atLeastVol', int), ('--threshold', 'threshold', int),
+               ('--width', 'width', int), ('--height', 'height', int), ('--stack-num', 'stack_num', int))
+    for flag, name, kind in options:
+        parser.add_argument(flag, dest=name, default=str(DEFAULT_PARAMS[name]),
+                            help=f'value, list or start:stop:step range (default {DEFAULT_PARAMS[name]})')
+    args = parser.parse_args(argv)
+
+    try:
+        grid = {name: parse_values(getattr(args, name), kind) for _, name, kind in options}
+    except ValueError as e:
+        parser.error(str(e))
+    base_params = {name: values[0] for name, values in grid.items()}
+    grid = {name: values for name, values in grid.items() if len(values) > 1}
+    rows = run_sweep(args.directory, base_params, grid, args.workers, backend=args.backend)
+    write_csv(rows, args.out)
+    swept = list(grid)
+    for row in rows:
+        print(', '.join(f'{name}={row[name]}' for name in swept) + f": {row['num_cells']}")
+    if len(swept) == 2:
+        row_values, col_values, table = pivot(rows, *swept)
+        print(f'\n{swept[0]} \\ {swept[1]}\t' + '\t'.join(map(str, col_values)))
+        for value, counts in zip(row_values, table):
+            print(f'{value}\t' + '\t'.join('' if count is None else str(count) for count in counts))
+
+
+if __name__ == '__main__':
+    main()
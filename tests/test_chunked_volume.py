@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from chunked_volume import ChunkedVolume, pack_volume
+
+KEYS = [
+    3, -1, slice(None), slice(2, 9), slice(5, 5), slice(None, None, 3), slice(None, None, -1),
+    (4, slice(7, 20)), (slice(1, 18), slice(3, 30), slice(10, 44)), (slice(None), 31, slice(None, None, 2)),
+    (np.int64(19), -2, 0), (slice(-5, None), slice(8, 16), slice(16, 32)),
+]
+
+
+@pytest.fixture
+def packed(tmp_path):
+    rng = np.random.default_rng(0)
+    gray = rng.integers(0, 256, (20, 33, 45), dtype=np.uint8)
+    color = rng.integers(0, 2**16, (20, 33, 45, 3), dtype=np.uint16)
+    path = str(tmp_path / 'stack.svol')
+    # Chunks that do not divide the shape, so edge chunks are partial; a budget of a few chunks forces eviction
+    pack_volume(path, {'gray': gray, 'color': color}, {'namelist': ['a', 'b']}, chunks=(4, 8, 16))
+    volume = ChunkedVolume(path, cache_budget=4 * 4 * 8 * 16 * 3 * 2)
+    yield volume, gray, color
+    volume.close()
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_indexing_matches_numpy(packed, key):
+    volume, gray, color = packed
+    np.testing.assert_array_equal(volume.datasets['gray'][key], gray[key])
+    np.testing.assert_array_equal(volume.datasets['color'][key], color[key])
+
+
+def test_round_trip(packed):
+    volume, gray, color = packed
+    assert volume.meta['namelist'] == ['a', 'b']
+    assert volume.datasets['color'].shape == color.shape and volume.datasets['color'].dtype == color.dtype
+    np.testing.assert_array_equal(np.asarray(volume.datasets['gray']), gray)
+    np.testing.assert_array_equal(np.stack(list(volume.datasets['color'])), color)
+    np.testing.assert_array_equal(volume.datasets['color'][2, 5:9, :, 1], color[2, 5:9, :, 1])
+
+
+def test_invalid_indices(packed):
+    volume, _, _ = packed
+    with pytest.raises(IndexError):
+        volume.datasets['gray'][20]
+    with pytest.raises(TypeError):
+        volume.datasets['gray'][[0, 1]]
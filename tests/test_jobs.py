@@ -0,0 +1,138 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import JobQueue
+
+
+class FakeStore:
+    def __init__(self, directory, slices=10):
+        self.directory = directory
+        self.cache_dir = directory
+        self.is_loaded = False
+        self.slices = slices
+
+    def __len__(self):
+        return self.slices
+
+
+class FakeCounter:
+    """Stands in for ``count_in_subprocess``: each job runs until the test releases it by name."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def event(self, name):
+        with self.lock:
+            return self.events.setdefault(name, threading.Event())
+
+    def release(self, name):
+        self.event(name).set()
+
+    def __call__(self, params, progress, directory=None, backend=None):
+        event = self.event(params['name'])
+        while not event.wait(0.01):
+            progress.check()
+        return 7
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def counter(monkeypatch):
+    counter = FakeCounter()
+    monkeypatch.setattr(jobs, 'count_in_subprocess', counter)
+    monkeypatch.setattr(jobs, 'estimate_memory', lambda params, slices: params['memory'])
+    return counter
+
+
+@pytest.fixture
+def make_queue(counter, tmp_path):
+    queues = []
+
+    def make_queue(workers=4, memory_budget=100):
+        queue = JobQueue(workers=workers, memory_budget=memory_budget, save_results=False)
+        queues.append(queue)
+        return queue
+
+    def submit(queue, name, memory=10, store=None):
+        store = store or FakeStore(str(tmp_path / name))
+        return queue.submit({'name': name, 'memory': memory}, backend='staged', store=store)
+
+    make_queue.submit = submit
+    yield make_queue
+    for queue in queues:
+        queue.cancel_all()
+        wait_for(lambda: all(job.finished for job in queue.jobs))
+
+
+def states(*jobs):
+    return [job.state for job in jobs]
+
+
+def test_worker_limit(counter, make_queue):
+    queue = make_queue(workers=2)
+    a, b, c, d = (make_queue.submit(queue, name) for name in 'abcd')
+    assert states(a, b, c, d) == ['running', 'running', 'queued', 'queued']
+    counter.release('a')
+    wait_for(lambda: a.state == 'done' and c.state == 'running')
+    assert a.num_cells == 7
+    assert states(b, d) == ['running', 'queued']
+
+
+def test_memory_budget_keeps_queue_order(counter, make_queue):
+    queue = make_queue(memory_budget=100)
+    a = make_queue.submit(queue, 'a', memory=60)
+    b = make_queue.submit(queue, 'b', memory=60)
+    # Fits next to a, but must not overtake b
+    c = make_queue.submit(queue, 'c', memory=10)
+    assert states(a, b, c) == ['running', 'queued', 'queued']
+    assert queue.memory_in_use == 60
+    counter.release('a')
+    wait_for(lambda: b.state == 'running' and c.state == 'running')
+    assert queue.memory_in_use == 70
+
+
+def test_oversize_job_runs_alone(counter, make_queue):
+    queue = make_queue(memory_budget=100)
+    a = make_queue.submit(queue, 'a', memory=10)
+    big = make_queue.submit(queue, 'big', memory=500)
+    c = make_queue.submit(queue, 'c', memory=10)
+    assert states(a, big, c) == ['running', 'queued', 'queued']
+    counter.release('a')
+    wait_for(lambda: big.state == 'running')
+    assert c.state == 'queued'
+    counter.release('big')
+    wait_for(lambda: c.state == 'running')
+
+
+def test_cancel_queued_and_running_jobs(counter, make_queue):
+    queue = make_queue(workers=1)
+    a, b, c = (make_queue.submit(queue, name) for name in 'abc')
+    queue.cancel(b)
+    assert b.state == 'cancelled'
+    queue.cancel(a)
+    wait_for(lambda: a.state == 'cancelled' and c.state == 'running')
+    assert b.state == 'cancelled'
+    assert a.num_cells is None
+
+
+def test_same_stack_waits_for_cache(counter, make_queue, tmp_path):
+    queue = make_queue()
+    store = FakeStore(str(tmp_path / 'stack'))
+    first = make_queue.submit(queue, 'first', store=store)
+    second = make_queue.submit(queue, 'second', store=store)
+    other = make_queue.submit(queue, 'other')
+    assert states(first, second, other) == ['running', 'queued', 'running']
+    # A progress report after the cache is complete lets the waiting job share it
+    store.is_loaded = True
+    first.progress.callback(0.5, 'Loaded')
+    assert second.state == 'running'
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from label_stats import label_stats
+from segmentation import plan_tiles, tiled_slic
+
+THRESHOLD = 60
+
+
+def blobs(shape=(24, 128, 128), n=60, seed=0):
+    # Bright ellipsoids, flattened along z like the resized stacks, on a dim noisy background
+    rng = np.random.default_rng(seed)
+    z, y, x = np.indices(shape, dtype=np.float32)
+    volume = rng.normal(20, 5, shape).astype(np.float32)
+    for cz, cy, cx in rng.random((n, 3)) * shape:
+        radius = rng.uniform(5, 9)
+        volume[((z - cz) * 3) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 < radius ** 2] = rng.uniform(120, 220)
+    return np.clip(volume, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize('compactness', [0.5, 20])
+def test_tiled_slic_matches_whole_volume(compactness):
+    volume = blobs()
+    foreground = volume >= THRESHOLD
+    assert len(plan_tiles(volume.shape, 500, 2 * 2**20)) > 1
+    whole = label_stats(tiled_slic(volume, 500, compactness, THRESHOLD), volume)
+    labels = tiled_slic(volume, 500, compactness, THRESHOLD, memory_budget=2 * 2**20, workers=4)
+    # Every foreground voxel is labelled, the background never is
+    assert not (foreground & (labels == 0)).any()
+    assert not (~foreground & (labels > 0)).any()
+    tiled = label_stats(labels, volume)
+    for args in ((0, 100), (20, 100)):
+        expected = len(whole.select(*args, THRESHOLD))
+        assert abs(len(tiled.select(*args, THRESHOLD)) - expected) <= 0.05 * expected
+
+
+
+def test_tiled_slic_gives_seam_crossing_supervoxels_one_label():
+    # One supervoxel per blob, and every blob straddles tile seams; at low compactness supervoxels follow the
+    # blobs across the seams
+    shape = (24, 128, 128)
+    z, y, x = np.indices(shape)
+    volume = np.full(shape, 10, dtype=np.uint8)
+    centres = [(12, cy, cx) for cy in (32, 64, 96) for cx in (32, 64, 96)]
+    for cz, cy, cx in centres:
+        volume[((z - cz) * 2) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 < 36] = 200
+    foreground = volume >= THRESHOLD
+    budget = 2 * 2**20
+    cores = [core for core, _ in plan_tiles(shape, 9 * volume.size / np.count_nonzero(foreground), budget)]
+    labels = tiled_slic(volume, 9, 0.5, THRESHOLD, memory_budget=budget, workers=4)
+    blob_labels = []
+    for cz, cy, cx in centres:
+        blob = (slice(cz - 3, cz + 4), slice(cy - 6, cy + 7), slice(cx - 6, cx + 7))
+        # The blob lies in more than one tile core
+        assert sum(all(s.start < b.stop and b.start < s.stop for s, b in zip(core, blob)) for core in cores) > 1
+        found = np.unique(labels[blob][foreground[blob]])
+        assert len(found) == 1 and found[0] > 0
+        blob_labels.append(found[0])
+    # Each blob is kept by exactly one tile, so no two blobs share a label and no blob is labelled twice
+    assert len(set(blob_labels)) == len(centres)
+    assert len(np.unique(labels)) - 1 == len(centres)
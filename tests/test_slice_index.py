@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+import pytest
+
+from slice_index import index_slices, read_header, template_pattern
+
+TEMPLATE = 'C001Z{:03d}.tif'
+
+
+def write_slices(directory, names, shape=(8, 12), dtype=np.uint8):
+    for value, name in enumerate(names):
+        cv2.imwrite(str(directory / name), np.full(shape, value, dtype=dtype))
+
+
+def test_template_orders_by_z_index_and_ignores_other_files(tmp_path):
+    write_slices(tmp_path, ['C001Z010.tif', 'C001Z002.tif', 'C001Z001.tif', 'overview.tif'])
+    manifest = index_slices(str(tmp_path), TEMPLATE)
+    assert manifest.ordering == 'template'
+    assert manifest.names == ['C001Z001.tif', 'C001Z002.tif', 'C001Z010.tif']
+    assert manifest.z == [1, 2, 10]
+    assert any('do not match' in issue for issue in manifest.issues)
+
+
+def test_natural_sort_without_template(tmp_path):
+    write_slices(tmp_path, ['slice10.tif', 'slice2.tif', 'slice1.tif'])
+    manifest = index_slices(str(tmp_path))
+    assert manifest.ordering == 'natural'
+    assert manifest.names == ['slice1.tif', 'slice2.tif', 'slice10.tif']
+    assert manifest.issues == ['7 Z indices are missing: 3-9']
+
+
+def test_template_matching_nothing_falls_back_to_natural_sort(tmp_path):
+    write_slices(tmp_path, ['b2.tif', 'b1.tif'])
+    manifest = index_slices(str(tmp_path), TEMPLATE)
+    assert manifest.ordering == 'natural'
+    assert manifest.names == ['b1.tif', 'b2.tif']
+    assert any('No file matches' in issue for issue in manifest.issues)
+
+
+def test_gaps_are_reported(tmp_path):
+    write_slices(tmp_path, [TEMPLATE.format(z) for z in (1, 2, 4, 5, 8)])
+    manifest = index_slices(str(tmp_path), TEMPLATE)
+    assert manifest.z == [1, 2, 4, 5, 8]
+    assert manifest.issues == ['3 Z indices are missing: 3, 6-7']
+
+
+def test_duplicate_z_indices_keep_the_first_name(tmp_path):
+    write_slices(tmp_path, ['s01.tif', 's1.tif', 's2.tif'])
+    manifest = index_slices(str(tmp_path))
+    assert manifest.names == ['s01.tif', 's2.tif']
+    assert manifest.issues == ['Z 1: s1.tif duplicates s01.tif and is ignored']
+
+
+def test_shape_mismatch_is_rejected_on_check(tmp_path):
+    write_slices(tmp_path, [TEMPLATE.format(z) for z in (1, 2, 3)])
+    write_slices(tmp_path, [TEMPLATE.format(4)], shape=(8, 13))
+    manifest = index_slices(str(tmp_path), TEMPLATE)
+    assert manifest.shape == (8, 12)
+    assert manifest.mismatched == [TEMPLATE.format(4)]
+    with pytest.raises(ValueError):
+        manifest.check()
+
+
+@pytest.mark.parametrize('shape, dtype', [((8, 12), np.uint8), ((8, 12), np.uint16), ((8, 12, 3), np.uint8)])
+def test_header_matches_decoded_image(tmp_path, shape, dtype):
+    path = str(tmp_path / 'slice.tif')
+    cv2.imwrite(path, np.zeros(shape, dtype=dtype))
+    assert read_header(path) == (shape, np.dtype(dtype).name)
+
+
+def test_template_needs_a_z_field():
+    assert template_pattern('a{}_Z{:03d}.tif').match('a7_Z012.tif').group(1) == '012'
+    with pytest.raises(ValueError):
+        template_pattern('no_field.tif')
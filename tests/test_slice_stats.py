@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import pytest
+
+from slice_stats import SliceStats, load_sidecar, save_sidecar, slice_histogram
+
+
+@pytest.fixture
+def slices():
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, (6, 31, 17), dtype=np.uint8)
+    images[images < 40] = 0
+    images[2] = 0
+    images[3, 0, 0] = 7
+    images[3, 1:] = 0
+    images[3, 0, 1:] = 0
+    images[4] = 250
+    return images
+
+
+def test_matches_numpy_on_foreground(slices):
+    stats = SliceStats([slice_histogram(image) for image in slices])
+    for i, image in enumerate(slices):
+        foreground = image[image > 0]
+        if foreground.size:
+            assert stats.mean[i] == pytest.approx(foreground.mean())
+            assert stats.median[i] == np.median(foreground)
+        else:
+            assert np.isnan(stats.mean[i]) and np.isnan(stats.median[i])
+        assert stats.larger_100[i] == np.count_nonzero(image >= 100)
+
+
+def test_reference_index_skips_empty_slices(slices):
+    stats = SliceStats([slice_histogram(image) for image in slices])
+    assert stats.reference_index('mean') == 4
+    assert stats.reference_index('median') == int(np.nanargmax(stats.median))
+    assert stats.reference_index('larger100') == 4
+    with pytest.raises(ValueError):
+        stats.reference_index('brightest')
+
+
+def test_sidecar_round_trip(tmp_path, slices):
+    stats = SliceStats([slice_histogram(image) for image in slices])
+    missing = str(tmp_path / 'missing')
+    path = save_sidecar(stats, 'key1', missing, str(tmp_path))
+    assert os.path.dirname(path) == str(tmp_path)
+    np.testing.assert_array_equal(load_sidecar('key1', missing, str(tmp_path)).hist, stats.hist)
+    assert load_sidecar('key2', str(tmp_path)) is None
@@ -0,0 +1,29 @@
+import pytest
+
+from sweep import expand_grid, parse_values
+
+
+@pytest.mark.parametrize('text, kind, expected', [
+    ('5,10,20', int, [5, 10, 20]),
+    ('5, 10,', int, [5, 10]),
+    ('20:80:20', int, [20, 40, 60, 80]),
+    ('20:70:20', int, [20, 40, 60]),
+    ('80:20:-20', int, [80, 60, 40, 20]),
+    ('20:10:5', int, []),
+    ('0.1:0.3:0.1', float, pytest.approx([0.1, 0.2, 0.3])),
+    ('mean,median', str, ['mean', 'median']),
+])
+def test_parse_values(text, kind, expected):
+    assert parse_values(text, kind) == expected
+
+
+@pytest.mark.parametrize('text', ['1:10:0', '1:10', '1:2:3:4', 'a:b:c', 'x'])
+def test_parse_values_rejects_bad_input(text):
+    with pytest.raises(ValueError):
+        parse_values(text)
+
+
+def test_expand_grid():
+    points = expand_grid({'threshold': 40, 'compactness': 50}, {'compactness': [20, 30], 'atLeastVol': [1, 2]})
+    assert [(p['compactness'], p['atLeastVol'], p['threshold']) for p in points] == [
+        (20, 1, 40), (20, 2, 40), (30, 1, 40), (30, 2, 40)]
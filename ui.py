@@ -1,37 +1,247 @@
 import sys
 import os
-import cv2
+import sqlite3
 import numpy as np
 from PyQt5.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, 
                              QFileDialog, QLabel, QHBoxLayout, QMainWindow, 
                              QSlider, QStackedWidget, QDesktopWidget, QLineEdit, 
-                             QComboBox, QFormLayout, QSpinBox, QProgressDialog)
-from PyQt5.QtGui import QFont, QIcon, QPixmap, QCursor
+                             QComboBox, QFormLayout, QSpinBox, QProgressDialog,
+                             QTableWidget, QTableWidgetItem, QCheckBox, QProgressBar,
+                             QAbstractItemView)
+from PyQt5.QtGui import QFont, QIcon, QPixmap, QCursor, QColor
 from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
-from PIL import Image
-from visualizer import StackedImageVisualizer
-from mayavi import mlab
-from sense_v2 import perform_cell_counting
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from matplotlib.figure import Figure
-
-class CellCountingThread(QThread):
-    progress = pyqtSignal(str)
-    finished = pyqtSignal(int)
-
-    def __init__(self, params):
+import instrumentation
+from counting import BACKENDS, COUNTING_BACKEND, CountingCancelled, CountingProgress
+from jobs import JobQueue
+from volume_store import open_store
+from slice_index import DEFAULT_TEMPLATE
+from chunked_volume import EXTENSION, pack_directory
+from pyramid import choose_level
+from results_store import ResultsStore
+from sweep import parse_values, run_sweep
+
+class SweepThread(QThread):
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, params, grid, backend=None):
         super().__init__()
+        self.directory = directory
         self.params = params
+        self.grid = grid
+        self.backend = backend
+        self.token = CountingProgress(lambda fraction, message: self.progress.emit(int(fraction * 100), message))
+
+    def cancel(self):
+        self.token.cancel()
+
+    def run(self):
+        try:
+            rows = run_sweep(self.directory, self.params, self.grid, progress=self.token, backend=self.backend)
+        except CountingCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.finished.emit(rows)
+
+class SweepResultsWindow(QMainWindow):
+    def __init__(self, rows, swept):
+        super().__init__()
+        self.setWindowTitle("SENSE - Parameter Sweep")
+        self.setWindowIcon(QIcon('transparentlogo.png'))
+        columns = list(swept) + ['num_cells']
+        table = QTableWidget(len(rows), len(columns))
+        table.setHorizontalHeaderLabels(columns)
+        counts = [row['num_cells'] for row in rows]
+        low, high = min(counts, default=0), max(counts, default=0)
+        for i, row in enumerate(rows):
+            for j, name in enumerate(columns):
+                table.setItem(i, j, QTableWidgetItem(str(row[name])))
+            # Shade the count column like a heatmap, darker green for more cells
+            share = (row['num_cells'] - low) / (high - low) if high > low else 0.0
+            table.item(i, len(columns) - 1).setBackground(QColor.fromHsvF(0.25, 0.15 + 0.7 * share, 0.95))
+        table.resizeColumnsToContents()
+        self.setCentralWidget(table)
+        self.resize(500, 400)
+
+class ProfileSummaryWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("SENSE - Timings")
+        self.setWindowIcon(QIcon('transparentlogo.png'))
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        self.table = QTableWidget(0, 7)
+        self.table.setHorizontalHeaderLabels(['Span', 'Calls', 'Wall s', 'CPU s', 'Process CPU s', 'Peak MB',
+                                              'RSS MB'])
+        layout.addWidget(self.table)
+        buttons = QHBoxLayout()
+        exportButton = QPushButton('Export Trace')
+        exportButton.clicked.connect(self.export_trace)
+        clearButton = QPushButton('Clear')
+        clearButton.clicked.connect(self.clear)
+        buttons.addStretch(1)
+        buttons.addWidget(exportButton)
+        buttons.addWidget(clearButton)
+        layout.addLayout(buttons)
+        self.setCentralWidget(widget)
+        self.resize(640, 400)
+        self.refresh()
+
+    def refresh(self):
+        rows = instrumentation.summary()
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            values = (row['name'], row['calls'], f"{row['wall_s']:.3f}", f"{row['cpu_s']:.3f}",
+                      f"{row['process_cpu_s']:.3f}", instrumentation.format_megabytes(row['peak']),
+                      instrumentation.format_megabytes(row['rss']))
+            for j, value in enumerate(values):
+                self.table.setItem(i, j, QTableWidgetItem(str(value)))
+        self.table.resizeColumnsToContents()
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Trace', 'sense_trace.json', 'Chrome trace (*.json)')
+        if path:
+            instrumentation.export_chrome_trace(path)
+
+    def clear(self):
+        instrumentation.clear()
+        self.refresh()
+
+class JobsWindow(QMainWindow):
+    COLUMNS = ['Stack', 'Parameters', 'Slices', 'Memory MB', 'Status', 'Progress', 'Cells']
+
+    def __init__(self, queue):
+        super().__init__()
+        self.setWindowTitle("SENSE - Cell Counting Jobs")
+        self.setWindowIcon(QIcon('transparentlogo.png'))
+        self.queue = queue
+        self.rows = {}
+        widget = QWidget()
+        layout = QVBoxLayout(widget)
+        self.summaryLabel = QLabel('')
+        layout.addWidget(self.summaryLabel)
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.table)
+        buttons = QHBoxLayout()
+        self.addButton = QPushButton('Add Stack...')
+        cancelButton = QPushButton('Cancel Selected')
+        cancelButton.clicked.connect(self.cancel_selected)
+        clearButton = QPushButton('Clear Finished')
+        clearButton.clicked.connect(self.clear_finished)
+        buttons.addWidget(self.addButton)
+        buttons.addStretch(1)
+        buttons.addWidget(cancelButton)
+        buttons.addWidget(clearButton)
+        layout.addLayout(buttons)
+        self.setCentralWidget(widget)
+        self.resize(900, 400)
+        for job in self.queue.jobs:
+            self.update_job(job)
+
+    def update_job(self, job):
+        row = self.rows.get(job.id)
+        if row is None:
+            row = self.rows[job.id] = self.table.rowCount()
+            self.table.insertRow(row)
+            params = job.params
+            described = (f"{params['refer_type']}, {params['numOfSupervoxel']} supervoxels, "
+                         f"compactness {params['compactness']}, bright {params['atLeastBright']}, "
+                         f"volume {params['atLeastVol']}, threshold {params['threshold']}, "
+                         f"{params['width']}x{params['height']}, {job.backend}")
+            for column, value in enumerate((job.directory, described, job.slices, f'{job.memory / 2**20:.0f}')):
+                self.table.setItem(row, column, QTableWidgetItem(str(value)))
+            self.table.setCellWidget(row, 5, QProgressBar())
+        self.table.setItem(row, 4, QTableWidgetItem(job.state))
+        progress = self.table.cellWidget(row, 5)
+        progress.setValue(int(job.fraction * 100))
+        progress.setFormat(job.message)
+        progress.setToolTip(job.message)
+        self.table.setItem(row, 6, QTableWidgetItem('' if job.num_cells is None else str(job.num_cells)))
+        running = self.queue.running
+        queued = sum(job.state == 'queued' for job in self.queue.jobs)
+        self.summaryLabel.setText(f'{len(running)} running, {queued} queued; estimated memory '
+                                  f'{self.queue.memory_in_use / 2**30:.1f} of {self.queue.memory_budget / 2**30:.1f} GB, '
+                                  f'at most {self.queue.workers} jobs at once')
+
+    def cancel_selected(self):
+        selected = {index.row() for index in self.table.selectionModel().selectedRows()}
+        for job in self.queue.jobs:
+            if self.rows.get(job.id) in selected and not job.finished:
+                self.queue.cancel(job)
+
+    def clear_finished(self):
+        self.queue.clear_finished()
+        self.rows = {}
+        self.table.setRowCount(0)
+        for job in self.queue.jobs:
+            self.update_job(job)
+
+class PackThread(QThread):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, directory, path):
+        super().__init__()
+        self.directory = directory
+        self.path = path
+
+    def run(self):
+        try:
+            pack_directory(self.directory, self.path, progress=self.progress.emit)
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.finished.emit(self.path)
+
+class SliceLoaderThread(QThread):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, store, workers=None, use_processes=None):
+        super().__init__()
+        self.store = store
+        self.workers = workers
+        self.use_processes = use_processes
+        self.cancelled = False
+
+    def cancel(self):
+        # The load stops at its next decoded slice and removes its partial files
+        self.cancelled = True
+
+    def report(self, done, total):
+        if self.cancelled:
+            raise CountingCancelled()
+        self.progress.emit(done, total)
 
     def run(self):
-        self.progress.emit("Image histogram matching is running...")
-        # Execute cell counting algorithm
-        num_cells = perform_cell_counting(**self.params)
-        self.finished.emit(num_cells)
+        try:
+            self.store.load(self.workers, self.use_processes, self.report)
+        except CountingCancelled:
+            pass
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.finished.emit(self.store)
 
 class VolumeRenderingApp(QMainWindow):
+    job_changed = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
+        # Job threads report through the signal, so the panel is only touched from the GUI thread
+        self.job_queue = JobQueue(on_change=self.job_changed.emit)
+        self.job_changed.connect(self.update_job)
+        self.jobs_window = None
+        self.reported_jobs = set()
         self.initUI()
         
     def center(self):
@@ -149,6 +359,25 @@ class VolumeRenderingApp(QMainWindow):
 
         layout.addWidget(self.loadButton, alignment=Qt.AlignCenter)
 
+        self.volumeFileButtonsLayout = QHBoxLayout()
+        self.openVolumeButton = QPushButton('Open Volume File')
+        self.openVolumeButton.setCursor(QCursor(Qt.PointingHandCursor))
+        self.openVolumeButton.clicked.connect(self.load_volume_file)
+        self.packButton = QPushButton('Pack Directory')
+        self.packButton.setCursor(QCursor(Qt.PointingHandCursor))
+        self.packButton.clicked.connect(self.pack_directory)
+        self.volumeFileButtonsLayout.addStretch(1)
+        self.volumeFileButtonsLayout.addWidget(self.openVolumeButton)
+        self.volumeFileButtonsLayout.addWidget(self.packButton)
+        self.volumeFileButtonsLayout.addStretch(1)
+        layout.addLayout(self.volumeFileButtonsLayout)
+
+        # Off by default; when on, a timing summary opens after each load, render and count
+        self.profileCheck = QCheckBox('Record timings')
+        self.profileCheck.setChecked(instrumentation.ENABLED)
+        self.profileCheck.toggled.connect(instrumentation.enable)
+        layout.addWidget(self.profileCheck, alignment=Qt.AlignCenter)
+
         self.statusLabel = QLabel('')
         self.statusLabel.setFont(QFont('Arial', 7))
         self.statusLabel.setAlignment(Qt.AlignCenter)
@@ -200,6 +429,14 @@ class VolumeRenderingApp(QMainWindow):
         self.visualizationButtonsLayout.addWidget(self.visualize3DButton, alignment=Qt.AlignCenter)
 
         layout.addLayout(self.visualizationButtonsLayout)
+
+        formLayout = QFormLayout()
+        self.voxelBudgetSpin = QSpinBox()
+        self.voxelBudgetSpin.setRange(1, 4096)
+        self.voxelBudgetSpin.setValue(64)
+        self.voxelBudgetSpin.setSuffix(' M')
+        formLayout.addRow('3D Voxel Budget:', self.voxelBudgetSpin)
+        layout.addLayout(formLayout)
         self.statusLabel = QLabel('')
         self.statusLabel.setFont(QFont('Arial', 7))
         self.statusLabel.setAlignment(Qt.AlignCenter)
@@ -211,7 +448,7 @@ class VolumeRenderingApp(QMainWindow):
 
         formLayout = QFormLayout()
 
-        self.filenameTemplateEdit = QLineEdit('HepaRG_n1 P3 D7_1000_4_C001Z{:03d}.tif')
+        self.filenameTemplateEdit = QLineEdit(DEFAULT_TEMPLATE)
         formLayout.addRow('Filename Template:', self.filenameTemplateEdit)
 
         self.referTypeCombo = QComboBox()
@@ -258,6 +495,11 @@ class VolumeRenderingApp(QMainWindow):
         self.stackNumSpin.setValue(2)
         formLayout.addRow('Stack Number:', self.stackNumSpin)
 
+        self.backendCombo = QComboBox()
+        self.backendCombo.addItems(BACKENDS)
+        self.backendCombo.setCurrentText(COUNTING_BACKEND)
+        formLayout.addRow('Pipeline:', self.backendCombo)
+
         self.cellCountButton = QPushButton('Count Cells')
         self.cellCountButton.setCursor(QCursor(Qt.PointingHandCursor))
         self.cellCountButton.clicked.connect(self.perform_cell_counting)
@@ -276,8 +518,46 @@ class VolumeRenderingApp(QMainWindow):
         """)
         self.cellCountButton.setFixedSize(250, 100)
 
+        sweepLayout = QFormLayout()
+        # Each sweep field takes a list (10,20,30) or an inclusive range (10:50:10); empty fields are not swept
+        self.sweepEdits = {}
+        for name, label in (('numOfSupervoxel', 'Sweep Supervoxels:'), ('compactness', 'Sweep Compactness:'),
+                            ('atLeastBright', 'Sweep At Least Bright:'), ('atLeastVol', 'Sweep At Least Volume:'),
+                            ('threshold', 'Sweep Threshold:')):
+            edit = QLineEdit()
+            edit.setPlaceholderText('e.g. 10,20,30 or 10:50:10')
+            sweepLayout.addRow(label, edit)
+            self.sweepEdits[name] = edit
+
+        self.sweepButton = QPushButton('Run Sweep')
+        self.sweepButton.setCursor(QCursor(Qt.PointingHandCursor))
+        self.sweepButton.clicked.connect(self.perform_sweep)
+        self.sweepButton.setStyleSheet(self.cellCountButton.styleSheet())
+        self.sweepButton.setFixedSize(250, 100)
+
+        self.jobsButton = QPushButton('Jobs')
+        self.jobsButton.setCursor(QCursor(Qt.PointingHandCursor))
+        self.jobsButton.clicked.connect(self.show_jobs)
+        self.jobsButton.setStyleSheet(self.cellCountButton.styleSheet())
+        self.jobsButton.setFixedSize(250, 100)
+
+        self.exportCellsButton = QPushButton('Export Cells')
+        self.exportCellsButton.setCursor(QCursor(Qt.PointingHandCursor))
+        self.exportCellsButton.clicked.connect(self.export_cells)
+        self.exportCellsButton.setStyleSheet(self.cellCountButton.styleSheet())
+        self.exportCellsButton.setFixedSize(250, 100)
+        # Enabled once a run with per-cell measurements is stored
+        self.exportCellsButton.setEnabled(False)
+
+        self.countingButtonsLayout = QHBoxLayout()
+        self.countingButtonsLayout.addWidget(self.cellCountButton, alignment=Qt.AlignCenter)
+        self.countingButtonsLayout.addWidget(self.sweepButton, alignment=Qt.AlignCenter)
+        self.countingButtonsLayout.addWidget(self.jobsButton, alignment=Qt.AlignCenter)
+        self.countingButtonsLayout.addWidget(self.exportCellsButton, alignment=Qt.AlignCenter)
+
         layout.addLayout(formLayout)
-        layout.addWidget(self.cellCountButton, alignment=Qt.AlignCenter)
+        layout.addLayout(sweepLayout)
+        layout.addLayout(self.countingButtonsLayout)
 
         self.statusLabel = QLabel('')
         self.statusLabel.setFont(QFont('Arial', 7))
@@ -295,99 +575,319 @@ class VolumeRenderingApp(QMainWindow):
         self.content.setCurrentWidget(self.cellCountingWidget)
 
     def load_slices(self):
-        self.directory = QFileDialog.getExistingDirectory(self, 'Select Slice Directory')
-        if self.directory:
+        self.open_stack(QFileDialog.getExistingDirectory(self, 'Select Slice Directory'))
+
+    def load_volume_file(self):
+        path, _ = QFileDialog.getOpenFileName(self, 'Select Volume File', '', f'SENSE volumes (*{EXTENSION})')
+        self.open_stack(path)
+
+    def pack_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select Slice Directory to Pack')
+        if not directory:
+            return
+        path, _ = QFileDialog.getSaveFileName(self, 'Save Volume File', directory.rstrip('/\\') + EXTENSION,
+                                              f'SENSE volumes (*{EXTENSION})')
+        if not path:
+            return
+        self.pack_thread = PackThread(directory, path)
+        self.pack_thread.progress.connect(
+            lambda done, total: self.statusLabel.setText(f'Packing {directory}: {done}/{total}'))
+        self.pack_thread.finished.connect(self.open_stack)
+        self.pack_thread.failed.connect(lambda message: self.statusLabel.setText(f'Packing failed: {message}'))
+        self.pack_thread.start()
+
+    def open_stack(self, path):
+        # A slice directory or a packed volume file; both open as a shared volume store
+        if path:
+            # An exception escaping a Qt slot aborts the application, so a bad template is reported instead
+            try:
+                store = open_store(path, self.filenameTemplateEdit.text() or None)
+            except (OSError, ValueError) as e:
+                self.statusLabel.setText(f'Could not open {path}: {e}')
+                return
+            self.stop_loading()
+            self.directory, self.store = path, store
             self.statusLabel.setText(f'Selected directory: {self.directory}')
+            # Decode in the background so the pages stay responsive while the slices load
+            self.slice_loader_thread = SliceLoaderThread(self.store)
+            self.slice_loader_thread.progress.connect(self.update_loading_progress)
+            self.slice_loader_thread.finished.connect(self.slices_loaded)
+            self.slice_loader_thread.failed.connect(self.slices_failed)
+            self.slice_loader_thread.start()
         else:
+            self.directory = path
             self.statusLabel.setText('No directory selected.')
 
+    def stop_loading(self):
+        # The previous stack stops decoding and its signals no longer reach the status bar
+        loader = getattr(self, 'slice_loader_thread', None)
+        if loader is None or not loader.isRunning():
+            return
+        loader.cancel()
+        for signal in (loader.progress, loader.finished, loader.failed):
+            signal.disconnect()
+        # A QThread must outlive its run(), so stopped loaders are kept until they have returned
+        self.stopped_loaders = [thread for thread in getattr(self, 'stopped_loaders', []) if thread.isRunning()]
+        self.stopped_loaders.append(loader)
+
+    def update_loading_progress(self, done, total):
+        if self.sender() is not self.slice_loader_thread:
+            return
+        self.statusLabel.setText(f'Loading slices from {self.directory}: {done}/{total}')
+
+    def show_timings(self):
+        if not instrumentation.ENABLED:
+            return
+        if getattr(self, 'timings_window', None) is None:
+            self.timings_window = ProfileSummaryWindow()
+        self.timings_window.refresh()
+        self.timings_window.show()
+
+    def slices_loaded(self, store):
+        # Calls already queued by a stopped loader may still arrive
+        if store is not self.store:
+            return
+        message = f'Selected directory: {store.directory} ({len(store)} slices loaded)'
+        if store.issues:
+            message += f'\n{len(store.issues)} slice index warnings: ' + '; '.join(store.issues[:3])
+        self.statusLabel.setText(message)
+        self.show_timings()
+
+    def slices_failed(self, message):
+        if self.sender() is not self.slice_loader_thread:
+            return
+        self.statusLabel.setText(f'Loading slices failed: {message}')
+
+    def slices_loading(self):
+        if hasattr(self, 'slice_loader_thread') and self.slice_loader_thread.isRunning():
+            self.statusLabel.setText('Slices are still loading, please wait.')
+            return True
+        return False
+
     def visualize_2d_slices(self):
         if hasattr(self, 'directory') and self.directory:
-            self.visualizer = StackedImageVisualizer(self.directory)
+            # While the store is still decoding the viewer pages slices in lazily
+            # matplotlib's Qt backend is only imported once the 2D viewer is first opened
+            from visualizer import StackedImageVisualizer
+
+            self.visualizer = StackedImageVisualizer(self.directory, self.store)
             self.visualizer.show()
         else:
             self.statusLabel.setText('Please select a directory first.')
 
     def visualize_3d_volume(self):
+        if self.slices_loading():
+            return
         if hasattr(self, 'directory') and self.directory:
-            slices = self.load_slices_from_directory(self.directory)
-            if slices:
-                volume = np.stack(slices, axis=2)
-                self.render_volume(volume)
+            try:
+                with instrumentation.span('load volume', 'loading'):
+                    store = self.load_slices_from_directory(self.directory)
+            except (OSError, ValueError) as e:
+                self.statusLabel.setText(f'Could not load {self.directory}: {e}')
+                return
+            if len(store):
+                with instrumentation.span('render volume', 'rendering'):
+                    self.render_volume(store)
                 self.statusLabel.setText('3D volume rendering complete.')
+                self.show_timings()
             else:
                 self.statusLabel.setText('No slices were loaded. Please check the directory path and file format.')
         else:
             self.statusLabel.setText('Please select a directory first.')
 
     def load_slices_from_directory(self, directory):
-        slices = []
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith('.tif'):
-                filepath = os.path.join(directory, filename)
-                img = Image.open(filepath).convert('L')
-                slices.append(np.array(img))
-        return slices
-
-    def render_volume(self, volume):
+        template = self.filenameTemplateEdit.text() or None
+        store = getattr(self, 'store', None)
+        if store is None or store.directory != os.path.abspath(directory) or store.template != template:
+            self.store = open_store(directory, template)
+        return self.store.load()
+
+    def render_volume(self, store):
+        # Mayavi and VTK take seconds to import, so they are loaded on the first 3D render
+        from mayavi import mlab
+
+        # Show a level 8x below the voxel budget first and swap in the budget level once the camera rests
+        voxel_budget = self.voxelBudgetSpin.value() * 10**6
+        final_level = choose_level(store.gray.shape, voxel_budget)
+        interactive_level = choose_level(store.gray.shape, voxel_budget // 8)
+
         fig = mlab.figure(size=(800, 800), bgcolor=(0, 0, 0))
         fig.scene._title = 'SENSE - Simplifying Complex Cell Analysis'
-        mlab.pipeline.volume(mlab.pipeline.scalar_field(volume), figure=fig)
+        source = mlab.pipeline.scalar_field(self.volume_level(store, interactive_level))
+        source.spacing = [interactive_level] * 3
+        mlab.pipeline.volume(source, figure=fig)
+
+        if final_level != interactive_level:
+            refine_timer = QTimer(self)
+            refine_timer.setSingleShot(True)
+
+            def refine():
+                interactor.remove_observer(start_observer)
+                interactor.remove_observer(end_observer)
+                source.scalar_data = self.volume_level(store, final_level)
+                source.spacing = [final_level] * 3
+                fig.scene.render()
+
+            refine_timer.timeout.connect(refine)
+            interactor = fig.scene.interactor
+            start_observer = interactor.add_observer('StartInteractionEvent', lambda *args: refine_timer.stop())
+            end_observer = interactor.add_observer('EndInteractionEvent', lambda *args: refine_timer.start(1000))
+            refine_timer.start(1000)
+            self.refine_timer = refine_timer
         mlab.show()
 
+    def volume_level(self, store, factor):
+        # (row, col, slice) view of the shared grayscale volume or one of its pyramid levels
+        return np.transpose(store.level(factor), (1, 2, 0))
+
+    def counting_params(self):
+        filename_template = self.filenameTemplateEdit.text()
+        refer_type = self.referTypeCombo.currentText()
+        numOfSupervoxel = self.numOfSupervoxelSpin.value()
+        compactness = self.compactnessSpin.value()
+        atLeastBright = self.atLeastBrightSpin.value()
+        atLeastVol = self.atLeastVolSpin.value()
+        threshold = self.thresholdSpin.value()
+        width = self.widthSpin.value()
+        height = self.heightSpin.value()
+        stack_num = self.stackNumSpin.value()
+
+        return {
+            "image_path": self.directory,
+            "refer_type": refer_type,
+            "numOfSupervoxel": numOfSupervoxel,
+            "compactness": compactness,
+            "atLeastBright": atLeastBright,
+            "atLeastVol": atLeastVol,
+            "threshold": threshold,
+            "width": width,
+            "height": height,
+            "stack_num": stack_num,
+            "filename_template": filename_template or None
+        }
+
+    def open_progress_dialog(self, title, worker):
+        self.progress_dialog = QProgressDialog("Starting cell counting...", "Cancel", 0, 100, self)
+        self.progress_dialog.setWindowTitle(title)
+        self.progress_dialog.setWindowModality(Qt.WindowModal)
+        self.progress_dialog.setMinimumDuration(0)
+        self.progress_dialog.setValue(0)
+
+        worker.progress.connect(self.update_progress)
+        worker.cancelled.connect(self.cell_counting_cancelled)
+        worker.failed.connect(self.cell_counting_failed)
+        self.progress_dialog.canceled.connect(worker.cancel)
+        self.progress_dialog.canceled.connect(self.cancel_cell_counting)
+        worker.start()
+
+        self.progress_dialog.show()
+
     def perform_cell_counting(self):
+        if self.slices_loading():
+            return
         if hasattr(self, 'directory') and self.directory:
-            filename_template = self.filenameTemplateEdit.text()
-            refer_type = self.referTypeCombo.currentText()
-            numOfSupervoxel = self.numOfSupervoxelSpin.value()
-            compactness = self.compactnessSpin.value()
-            atLeastBright = self.atLeastBrightSpin.value()
-            atLeastVol = self.atLeastVolSpin.value()
-            threshold = self.thresholdSpin.value()
-            width = self.widthSpin.value()
-            height = self.heightSpin.value()
-            stack_num = self.stackNumSpin.value()
-
-            params = {
-                "image_path": self.directory,
-                "refer_type": refer_type,
-                "numOfSupervoxel": numOfSupervoxel,
-                "compactness": compactness,
-                "atLeastBright": atLeastBright,
-                "atLeastVol": atLeastVol,
-                "threshold": threshold,
-                "width": width,
-                "height": height,
-                "stack_num": stack_num
-            }
-
-            self.progress_dialog = QProgressDialog("Starting cell counting...", "Cancel", 0, 100, self)
-            self.progress_dialog.setWindowTitle("Cell Counting in Progress")
-            self.progress_dialog.setWindowModality(Qt.WindowModal)
-            self.progress_dialog.setMinimumDuration(0)
-            self.progress_dialog.setValue(0)
-
-            self.cell_counting_thread = CellCountingThread(params)
-            self.cell_counting_thread.progress.connect(self.update_progress)
-            self.cell_counting_thread.finished.connect(self.cell_counting_finished)
-            self.cell_counting_thread.start()
+            self.enqueue(self.counting_params(), self.store)
+        else:
+            self.statusLabel.setText('Please select a directory first.')
 
-            self.progress_dialog.show()
+    def enqueue(self, params, store=None):
+        # Counting runs as a queued job; the parameters are taken now, so the form can change for the next one
+        try:
+            job = self.job_queue.submit(params, self.backendCombo.currentText(), store)
+        except (OSError, ValueError) as e:
+            self.statusLabel.setText(f'Could not queue {params["image_path"]}: {e}')
+            return
+        self.statusLabel.setText(f'Queued cell counting job {job.id} for {job.directory}')
+        self.show_jobs()
+
+    def enqueue_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, 'Select Slice Directory to Count')
+        if directory:
+            self.enqueue(dict(self.counting_params(), image_path=directory))
+
+    def show_jobs(self):
+        if self.jobs_window is None:
+            self.jobs_window = JobsWindow(self.job_queue)
+            self.jobs_window.addButton.clicked.connect(self.enqueue_directory)
+        self.jobs_window.show()
+        self.jobs_window.raise_()
+
+    def update_job(self, job):
+        if self.jobs_window is not None:
+            self.jobs_window.update_job(job)
+        if not job.finished or job.id in self.reported_jobs:
+            return
+        self.reported_jobs.add(job.id)
+        name = os.path.basename(job.directory.rstrip('/\\'))
+        if job.state == 'done':
+            self.statusLabel.setText(f'Number of cells counted in {name} (job {job.id}): {job.num_cells}'
+                                     + (f' (saved as run {job.run_id})' if job.run_id is not None else ''))
+            self.statusLabel.setStyleSheet('font-size: 18px')
+            if job.cells is not None and job.run_id is not None:
+                self.cells_run_id = job.run_id
+                self.exportCellsButton.setEnabled(True)
+            self.show_timings()
+        elif job.state == 'failed':
+            self.statusLabel.setText(f'Cell counting of {name} failed: {job.error}')
+
+    def perform_sweep(self):
+        if self.slices_loading():
+            return
+        if hasattr(self, 'directory') and self.directory:
+            try:
+                grid = {name: parse_values(edit.text()) for name, edit in self.sweepEdits.items() if edit.text().strip()}
+            except ValueError:
+                self.statusLabel.setText('Sweep values must be lists (10,20,30) or ranges (10:50:10).')
+                return
+            if not grid:
+                self.statusLabel.setText('Enter values for at least one sweep parameter.')
+                return
+            params = self.counting_params()
+            del params["image_path"]
+            self.sweep_thread = SweepThread(self.directory, params, grid, self.backendCombo.currentText())
+            self.sweep_thread.finished.connect(lambda rows: self.sweep_finished(rows, list(grid)))
+            self.open_progress_dialog("Parameter Sweep in Progress", self.sweep_thread)
         else:
             self.statusLabel.setText('Please select a directory first.')
 
-    def update_progress(self, message):
+    def update_progress(self, percent, message):
+        if self.progress_dialog.wasCanceled():
+            return
         self.progress_dialog.setLabelText(message)
-        value = self.progress_dialog.value()
-        self.progress_dialog.setValue(value + 20)  # Increment progress
+        # Stay below the maximum so the dialog only closes once the result is in
+        self.progress_dialog.setValue(min(percent, 99))
+
+    def cancel_cell_counting(self):
+        self.statusLabel.setText('Cancelling cell counting...')
+
+    def cell_counting_cancelled(self):
+        self.progress_dialog.close()
+        self.statusLabel.setText('Cell counting cancelled.')
+
+    def cell_counting_failed(self, message):
+        self.progress_dialog.close()
+        self.statusLabel.setText(f'Cell counting failed: {message}')
+
+    def export_cells(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Cells', f'cells_run{self.cells_run_id}.csv',
+                                              'CSV (*.csv);;Parquet (*.parquet);;Feather (*.feather)')
+        if not path:
+            return
+        try:
+            with ResultsStore() as results:
+                count = results.export_cells(path, [self.cells_run_id])
+        except (ImportError, sqlite3.Error, OSError) as e:
+            self.statusLabel.setText(f'Exporting cells failed: {e}')
+        else:
+            self.statusLabel.setText(f'Exported {count} cells to {path}')
 
-    def cell_counting_finished(self, num_cells):
+    def sweep_finished(self, rows, swept):
         self.progress_dialog.setValue(100)
         self.progress_dialog.close()
-        self.statusLabel.setText(f'Number of cells counted: {num_cells}')
-        self.statusLabel.setStyleSheet(
-            'font-size: 18px'
-        )
+        self.sweep_results = SweepResultsWindow(rows, swept)
+        self.sweep_results.show()
+        self.statusLabel.setText(f'Parameter sweep finished: {len(rows)} grid points.')
+        self.show_timings()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
@@ -1,45 +1,75 @@
-import sys
-import os
-import cv2
 import numpy as np
-from PyQt5.QtWidgets import (QApplication, QWidget, QMainWindow, QVBoxLayout, QLabel, QSlider)
+from PyQt5.QtWidgets import (QWidget, QMainWindow, QVBoxLayout, QHBoxLayout, QLabel, QSlider,
+                             QDoubleSpinBox)
 from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+from instrumentation import span
+from volume_store import PAGER_BUDGET, ChannelStack, SlicePager, open_store, read_native, read_slice
 
 class StackedImageVisualizer(QMainWindow):
-    def __init__(self, directory):
+    def __init__(self, directory, store=None, lazy=None, cache_budget=PAGER_BUDGET):
         super().__init__()
         self.image_path = directory
-        self.namelist = [file for file in os.listdir(self.image_path) if file.endswith('.tif')]
+        self.store = store or open_store(directory)
+        self.namelist = self.store.namelist
         self.length_of_namelist = len(self.namelist)
-        self.mean_bright = np.zeros((self.length_of_namelist, 1))
-        self.median_bright = np.zeros((self.length_of_namelist, 1))
-        self.larger_100 = np.zeros((self.length_of_namelist, 1))
         self.setWindowIcon(QIcon('transparentlogo.png'))
-        sample_img = cv2.imread(os.path.join(self.image_path, self.namelist[0]))
-        self.rows, self.cols, self.channels = sample_img.shape
-        self.stacked = np.zeros((self.rows, self.cols, self.channels, self.length_of_namelist), dtype=sample_img.dtype)
-
-        for i, file_name in enumerate(self.namelist):
-            img = cv2.imread(os.path.join(self.image_path, file_name))
-            image_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            self.mean_bright[i, 0] = np.mean(image_gray[image_gray > 0])
-            self.median_bright[i, 0] = np.median(image_gray[image_gray > 0])
-            self.larger_100[i, 0] = np.sum(image_gray >= 100)
-            self.stacked[:, :, :, i] = img
-
-        self.location1 = np.argmax(self.mean_bright)
-        self.location2 = np.argmax(self.median_bright)
-        self.location3 = np.argmax(self.larger_100)
-        self.stacked = np.transpose(self.stacked, (3, 0, 1, 2))
+        # Lazy mode pages slices in on demand, so the window opens while the store is still decoding
+        self.lazy = not self.store.is_loaded if lazy is None else lazy
+        native = getattr(self.store, 'native', False)
+        if self.lazy:
+            self.stacked = SlicePager(self.store.paths, cache_budget, reader=read_native if native else read_slice)
+        elif native:
+            # Native slices stay at their bit depth; windowing to the display happens per drawn frame
+            channels = self.store.load().channels
+            self.stacked = channels[0] if len(channels) == 1 else ChannelStack(channels)
+        else:
+            # (layer, row, col, channel) view of the shared memory-mapped volume, no copy is made
+            self.stacked = self.store.load().color
+        self.rows, self.cols = self.stacked[0].shape[:2]
+        if native and self.store.window:
+            self.display_window = (min(low for low, _ in self.store.window),
+                                   max(high for _, high in self.store.window))
+        elif native:
+            self.display_window = (float(np.min(self.stacked[0])), float(np.max(self.stacked[0])))
 
         self.setWindowTitle("SENSE")
-        self.stacked_widget = StackedWidget(self)
+        with span('open 2D viewer', 'viewer'):
+            self.stacked_widget = StackedWidget(self)
         self.setCentralWidget(self.stacked_widget)
         self.setWindowIcon(QIcon(''))
 
+    @property
+    def mean_bright(self):
+        return self.store.stats().mean[:, np.newaxis]
+
+    @property
+    def median_bright(self):
+        return self.store.stats().median[:, np.newaxis]
+
+    @property
+    def larger_100(self):
+        return self.store.stats().larger_100[:, np.newaxis]
+
+    @property
+    def location1(self):
+        return self.store.stats().reference_index('mean')
+
+    @property
+    def location2(self):
+        return self.store.stats().reference_index('median')
+
+    @property
+    def location3(self):
+        return self.store.stats().reference_index('larger100')
+
+    def closeEvent(self, event):
+        if self.lazy:
+            self.stacked.close()
+        super().closeEvent(event)
+
 class StackedWidget(QWidget):
     def __init__(self, parent=None):
         super(StackedWidget, self).__init__(parent)
@@ -51,23 +81,72 @@ class StackedWidget(QWidget):
         layout.addWidget(self.canvas)
 
         self.ax = self.figure.add_subplot(111)
+        self.image = None
+
+        # Slider ticks only schedule a redraw; ticks arriving before it runs collapse into one
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.timeout.connect(self.update_image)
 
         self.slider = QSlider(Qt.Horizontal)
         self.slider.setRange(0, self.parent().length_of_namelist - 1)
         self.slider.setValue(0)
         self.slider.setTickInterval(1)
         self.slider.setSingleStep(1)
-        self.slider.valueChanged.connect(self.update_image)
+        self.slider.valueChanged.connect(self.schedule_update)
         layout.addWidget(self.slider)
 
         self.layer_label = QLabel("Layer: 0")
         layout.addWidget(self.layer_label)
 
+        # Display window in the slices' own values; only the drawn frame is mapped to the screen range
+        dtype = self.parent().stacked[0].dtype
+        limits = (np.iinfo(dtype).min, np.iinfo(dtype).max) if np.issubdtype(dtype, np.integer) else (-1e9, 1e9)
+        low, high = getattr(self.parent(), 'display_window', limits)
+        window_layout = QHBoxLayout()
+        window_layout.addWidget(QLabel("Window:"))
+        self.window_low = QDoubleSpinBox()
+        self.window_high = QDoubleSpinBox()
+        for spin, value in ((self.window_low, low), (self.window_high, high)):
+            spin.setDecimals(0 if np.issubdtype(dtype, np.integer) else 3)
+            spin.setRange(*limits)
+            spin.setValue(value)
+            spin.valueChanged.connect(self.schedule_update)
+            window_layout.addWidget(spin)
+        layout.addLayout(window_layout)
+
         self.update_image()
 
+    def schedule_update(self):
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start(0)
+
     def update_image(self):
+        with span('redraw slice', 'viewer'):
+            self._update_image()
+
+    def _update_image(self):
         layer = self.slider.value()
-        self.ax.clear()
-        self.ax.imshow(cv2.cvtColor(self.parent().stacked[layer], cv2.COLOR_BGR2RGB))
+        frame = self.parent().stacked[layer]
+        low, high = self.window_low.value(), self.window_high.value()
+        if frame.ndim == 2:
+            # Single-channel frames are windowed by the colour map's norm when matplotlib draws them
+            if self.image is None:
+                self.image = self.ax.imshow(frame, cmap='gray', vmin=low, vmax=high)
+            else:
+                self.image.set_data(frame)
+                self.image.set_clim(low, high)
+        else:
+            # Reversing the channel axis is a zero-copy BGR to RGB view; two channels show as red and green
+            if frame.shape[2] >= 3:
+                rgb = frame[..., 2::-1]
+            else:
+                rgb = np.dstack([frame[..., 0], frame[..., 1], np.zeros_like(frame[..., 0])])
+            if rgb.dtype != np.uint8 or (low, high) != (0, 255):
+                rgb = np.clip((rgb.astype(np.float32) - low) / max(high - low, 1e-6), 0, 1)
+            if self.image is None:
+                self.image = self.ax.imshow(rgb)
+            else:
+                self.image.set_data(rgb)
         self.layer_label.setText(f"Layer: {layer}")
-        self.canvas.draw()
+        self.canvas.draw_idle()
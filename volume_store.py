@@ -0,0 +1,462 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import partial
+import cv2
+import numpy as np
+from instrumentation import span
+from chunked_volume import ChunkedStore, is_chunked_volume
+from disk_cache import CACHE_BUDGET, publish, temp_path, touch, trim_cache
+from pyramid import load_level
+from slice_index import index_slices
+from slice_stats import SliceStats, load_sidecar, save_sidecar, slice_histogram
+
+CACHE_ROOT = os.environ.get('SENSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.sense_cache'))
+LOADER_WORKERS = int(os.environ.get('SENSE_LOADER_WORKERS', 0)) or os.cpu_count() or 1
+LOADER_PROCESSES = os.environ.get('SENSE_LOADER_PROCESSES', '') == '1'
+PAGER_BUDGET = int(os.environ.get('SENSE_VIEWER_CACHE_MB', 512)) * 2**20
+PAGER_PREFETCH = 4
+# Native loading keeps the slices' bit depth and one array per channel instead of 8-bit BGR plus gray
+NATIVE_LOADING = os.environ.get('SENSE_NATIVE_LOADING', '') == '1'
+
+_stores = {}
+_worker_arrays = None
+
+
+def slice_manifest(directory, template=None):
+    return index_slices(directory, template, os.path.join(CACHE_ROOT, 'manifests'))
+
+
+def _read_image(path, flags):
+    # Reading the file and decoding it are separate steps, so a trace tells slow storage from slow decoding
+    with span('read file', 'loading'):
+        data = np.fromfile(path, dtype=np.uint8)
+    with span('decode slice', 'loading'):
+        img = cv2.imdecode(data, flags)
+    if img is None:
+        raise ValueError(f'Could not read slice {path}')
+    return img
+
+
+def read_slice(path):
+    return _read_image(path, cv2.IMREAD_COLOR)
+
+
+def read_native(path):
+    # Bit depth and channels as stored: (row, col) for single-channel slices, (row, col, channel) otherwise
+    return _read_image(path, cv2.IMREAD_UNCHANGED)
+
+
+def luminance(img):
+    if img.ndim == 2:
+        return img
+    if img.shape[2] in (3, 4):
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY if img.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+    return img.mean(axis=2).astype(img.dtype)
+
+
+def _open_worker_arrays(paths):
+    global _worker_arrays
+    _worker_arrays = [np.load(path, mmap_mode='r+') for path in paths]
+
+
+def _decode_into(arrays, path, index):
+    color, gray = arrays
+    img = read_slice(path)
+    color[index] = img
+    gray[index] = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # The histogram is taken while the slice is still hot in cache, so statistics need no second pass
+    return index, slice_histogram(gray[index])
+
+
+def _decode_native_into(channels, path, index):
+    img = read_native(path)
+    planes = [img] if img.ndim == 2 else cv2.split(img)
+    for channel, plane in zip(channels, planes):
+        channel[index] = plane
+    # Per-channel value range and the brightest luminance, for display windows and the 8-bit gray scale
+    ranges = [cv2.minMaxLoc(plane)[:2] for plane in planes]
+    return index, ranges, float(luminance(img).max())
+
+
+def _gray_into(arrays, path, index, scale=1.0):
+    channels, gray = arrays
+    img = channels[0][index] if len(channels) == 1 else cv2.merge([channel[index] for channel in channels])
+    if gray is not None:
+        gray[index] = cv2.convertScaleAbs(luminance(img), alpha=scale)
+        img = gray[index]
+    return index, slice_histogram(img)
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _decode_in_worker(decode, path, index):
+    result = decode(_worker_arrays, path, index)
+    for array in _worker_arrays:
+        array.flush()
+    return result
+
+
+class ChannelStack:
+    """(row, col, channel) slices merged from per-channel arrays on access."""
+
+    def __init__(self, channels):
+        self.channels = channels
+        self.shape = channels[0].shape + (len(channels),)
+        self.dtype = channels[0].dtype
+
+    def __len__(self):
+        return len(self.channels[0])
+
+    def __getitem__(self, index):
+        return cv2.merge([np.asarray(channel[index]) for channel in self.channels])
+
+
+class NativeColor:
+    """8-bit BGR slices composed from native channel arrays on access, for consumers of ``color``."""
+
+    def __init__(self, channels, scales):
+        self.channels = channels
+        self.scales = scales
+        self.shape = channels[0].shape + (3,)
+        self.dtype = np.dtype(np.uint8)
+
+    def __len__(self):
+        return len(self.channels[0])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        planes = []
+        for channel, scale in zip(self.channels[:3], self.scales):
+            plane = np.asarray(channel[key])
+            planes.append(cv2.convertScaleAbs(plane.reshape(-1, plane.shape[-1]), alpha=scale).reshape(plane.shape))
+        planes += planes * 2 if len(planes) == 1 else [np.zeros_like(planes[0])] * (3 - len(planes))
+        return np.stack(planes, axis=-1)
+
+
+def cache_key(directory, namelist, native=False):
+    # The decoded volume is reused only while every slice keeps its name, size and mtime. The directory is part
+    # of the key: copies of a stack keep sizes and mtimes, and look-alike stacks share both
+    digest = hashlib.sha1(b'native\n' if native else b'')
+    digest.update(f'{os.path.abspath(directory)}\n'.encode())
+    for file_name in namelist:
+        stat = os.stat(os.path.join(directory, file_name))
+        digest.update(f'{file_name}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+class VolumeStore:
+    """Decodes a directory of .tif slices once into memory-mapped arrays.
+
+    ``color`` holds the slices as read by cv2 (slice, row, col, channel) and
+    ``gray`` the matching grayscale volume (slice, row, col). Both are opened
+    read-only, so every consumer shares the same pages without copying.
+
+    With ``native`` the slices keep their bit depth: ``channels`` holds one
+    (slice, row, col) array per channel at the file's dtype and ``window`` the
+    value range of each. ``gray`` is then the 8-bit luminance scaled to the
+    stack's brightest voxel (the channel itself for 8-bit single-channel
+    stacks, so those are stored once) and ``color`` an 8-bit view composed on
+    access.
+    """
+
+    def __init__(self, directory, cache_root=CACHE_ROOT, template=None, native=NATIVE_LOADING):
+        self.directory = os.path.abspath(directory)
+        self.template = template
+        self.native = native
+        # Every consumer sees the slices in the manifest's Z order
+        self.manifest = slice_manifest(self.directory, template)
+        self.namelist = self.manifest.names
+        self.paths = [os.path.join(self.directory, file_name) for file_name in self.namelist]
+        self.key = cache_key(self.directory, self.namelist, native)
+        self.cache_dir = os.path.join(cache_root, self.key)
+        self.color = None
+        self.gray = None
+        self.channels = None
+        self.window = None
+        self._stats = None
+
+    def __len__(self):
+        return len(self.namelist)
+
+    @property
+    def issues(self):
+        return self.manifest.issues
+
+    @property
+    def is_loaded(self):
+        return self.gray is not None
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, 'meta.json')
+
+    def is_stale(self):
+        return (slice_manifest(self.directory, self.template).names != self.namelist
+                or cache_key(self.directory, self.namelist, self.native) != self.key)
+
+    def load(self, workers=None, use_processes=None, progress=None):
+        """Open the cached volume, decoding the slices first if needed.
+
+        Slices are decoded by ``workers`` threads (cv2 releases the GIL while
+        decoding) or, with ``use_processes``, by a process pool that writes
+        straight into the memory-mapped files. ``progress(done, total)`` is
+        called after every decoded slice.
+        """
+        if not self.namelist:
+            return self
+        if not os.path.exists(self.meta_path):
+            # Another process may have evicted the entry of an open store; its open arrays stay readable, but
+            # files derived from them need the entry back
+            self.manifest.check()
+            decode = self._decode_native if self.native else self._decode
+            with span('decode stack', 'loading', slices=len(self)):
+                decode(workers or LOADER_WORKERS, LOADER_PROCESSES if use_processes is None else use_processes,
+                       progress)
+            # Stores open in this process are in use even when they were loaded long ago
+            trim_cache(os.path.dirname(self.cache_dir), CACHE_BUDGET,
+                       keep=[self.cache_dir] + [store.cache_dir for store in list(_stores.values())])
+            self.color = self.gray = self.channels = None
+        touch(self.cache_dir)
+        if not self.is_loaded:
+            self._open()
+        return self
+
+    def _temp_arrays(self, names):
+        # Decoding writes to files of its own, so processes decoding the same stack never share one
+        return {temp_path(os.path.join(self.cache_dir, f'{name}.npy')): os.path.join(self.cache_dir, f'{name}.npy')
+                for name in names}
+
+    def _publish(self, files, meta):
+        # Another process may have completed the same entry meanwhile; its files are kept and ours dropped
+        if os.path.exists(self.meta_path):
+            for tmp_path in files:
+                os.remove(tmp_path)
+            return
+        for tmp_path, path in files.items():
+            publish(tmp_path, path)
+        save_sidecar(self._stats, self.key, self.directory, self.cache_dir)
+        # meta.json is written last and marks the cache entry as complete
+        tmp_path = temp_path(self.meta_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        publish(tmp_path, self.meta_path)
+
+    def _decode(self, workers, use_processes, progress):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sample_img = read_slice(self.paths[0])
+        rows, cols, channels = sample_img.shape
+        files = self._temp_arrays(('color', 'gray'))
+        color_path, gray_path = files
+        color = np.lib.format.open_memmap(color_path, mode='w+', dtype=sample_img.dtype,
+                                          shape=(len(self), rows, cols, channels))
+        gray = np.lib.format.open_memmap(gray_path, mode='w+', dtype=sample_img.dtype, shape=(len(self), rows, cols))
+        hist = np.zeros((len(self), 256), dtype=np.int64)
+        color[0] = sample_img
+        gray[0] = cv2.cvtColor(sample_img, cv2.COLOR_BGR2GRAY)
+        hist[0] = slice_histogram(gray[0])
+        color.flush()
+        gray.flush()
+
+        try:
+            if progress is not None:
+                progress(1, len(self))
+            for index, slice_hist in self._map_slices(_decode_into, (color, gray), list(files), range(1, len(self)),
+                                                      workers, use_processes, progress, done=1):
+                hist[index] = slice_hist
+            color.flush()
+            gray.flush()
+        except BaseException:
+            del color, gray
+            _remove_files(files)
+            raise
+        del color, gray
+        self._stats = SliceStats(hist)
+        self._publish(files, {'directory': self.directory, 'namelist': self.namelist,
+                              'shape': [len(self), rows, cols, channels], 'dtype': str(sample_img.dtype)})
+
+    def _decode_native(self, workers, use_processes, progress):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sample_img = read_native(self.paths[0])
+        rows, cols = sample_img.shape[:2]
+        n_channels = sample_img.shape[2] if sample_img.ndim == 3 else 1
+        # 8-bit single-channel stacks are their own gray volume
+        with_gray = n_channels > 1 or sample_img.dtype != np.uint8
+        files = self._temp_arrays([f'channel{c}' for c in range(n_channels)] + (['gray'] if with_gray else []))
+        channel_paths = list(files)[:n_channels]
+        channels = [np.lib.format.open_memmap(path, mode='w+', dtype=sample_img.dtype, shape=(len(self), rows, cols))
+                    for path in channel_paths]
+        gray = None
+        try:
+            ranges = np.zeros((len(self), n_channels, 2))
+            peaks = np.zeros(len(self))
+            for index, slice_ranges, peak in self._map_slices(_decode_native_into, channels, channel_paths,
+                                                              range(len(self)), workers, use_processes, progress):
+                ranges[index], peaks[index] = slice_ranges, peak
+
+            # 8-bit stacks keep their values; deeper ones are scaled so the brightest voxel maps to 255
+            scale = 1.0 if sample_img.dtype == np.uint8 else 255.0 / max(peaks.max(), 1.0)
+            if with_gray:
+                gray = np.lib.format.open_memmap(list(files)[-1], mode='w+', dtype=np.uint8,
+                                                 shape=(len(self), rows, cols))
+            hist = np.zeros((len(self), 256), dtype=np.int64)
+            for index, slice_hist in self._map_slices(partial(_gray_into, scale=scale), (channels, gray), None,
+                                                      range(len(self)), workers):
+                hist[index] = slice_hist
+            for array in channels + ([gray] if gray is not None else []):
+                array.flush()
+        except BaseException:
+            del channels, gray
+            _remove_files(files)
+            raise
+        del channels, gray
+        self._stats = SliceStats(hist)
+
+        window = [[float(ranges[:, c, 0].min()), float(ranges[:, c, 1].max())] for c in range(n_channels)]
+        self._publish(files, {'directory': self.directory, 'namelist': self.namelist, 'native': True,
+                              'shape': [len(self), rows, cols, n_channels], 'dtype': str(sample_img.dtype),
+                              'window': window, 'gray_scale': scale})
+
+    def _map_slices(self, decode, arrays, paths, indices, workers, use_processes=False, progress=None, done=0):
+        # Every task owns one slice index, so the preallocated arrays are filled in slice order
+        # regardless of which worker finishes first
+        if use_processes:
+            executor = ProcessPoolExecutor(workers, initializer=_open_worker_arrays, initargs=(paths,))
+            submit = lambda i: executor.submit(_decode_in_worker, decode, self.paths[i], i)
+        else:
+            executor = ThreadPoolExecutor(workers)
+            submit = lambda i: executor.submit(decode, arrays, self.paths[i], i)
+        results = []
+        with executor:
+            futures = [submit(i) for i in indices]
+            try:
+                for done, future in enumerate(as_completed(futures), start=done + 1):
+                    results.append(future.result())
+                    if progress is not None:
+                        progress(done, len(self))
+            except BaseException:
+                # A failed slice or a cancelled load only waits for the slices already being decoded
+                for future in futures:
+                    future.cancel()
+                raise
+        return results
+
+    def stats(self):
+        """Per-slice brightness statistics, read from the sidecar file when it is current."""
+        if self._stats is None:
+            self._stats = load_sidecar(self.key, self.directory, self.cache_dir)
+        if self._stats is None:
+            if self.is_loaded or self.native:
+                hist = [slice_histogram(image_gray) for image_gray in self.load().gray]
+            else:
+                hist = [slice_histogram(cv2.cvtColor(read_slice(path), cv2.COLOR_BGR2GRAY)) for path in self.paths]
+            self._stats = SliceStats(np.array(hist).reshape(len(self), 256))
+            save_sidecar(self._stats, self.key, self.directory, self.cache_dir)
+        return self._stats
+
+    def level(self, factor):
+        """Grayscale volume downsampled ``factor`` times per axis, cached next to the volume."""
+        return load_level(self.load().gray, self.cache_dir, factor)
+
+    def _open(self):
+        if not self.native:
+            self.color = np.load(os.path.join(self.cache_dir, 'color.npy'), mmap_mode='r')
+            self.gray = np.load(os.path.join(self.cache_dir, 'gray.npy'), mmap_mode='r')
+            return
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        self.channels = [np.load(os.path.join(self.cache_dir, f'channel{c}.npy'), mmap_mode='r')
+                         for c in range(meta['shape'][3])]
+        self.window = [tuple(window) for window in meta['window']]
+        gray_path = os.path.join(self.cache_dir, 'gray.npy')
+        self.gray = np.load(gray_path, mmap_mode='r') if os.path.exists(gray_path) else self.channels[0]
+        self.color = NativeColor(self.channels, [meta['gray_scale']] * len(self.channels))
+
+
+class SlicePager:
+    """Sequence of slices decoded on demand and kept in an LRU cache.
+
+    Indexing decodes only the requested slice and schedules the ``prefetch``
+    slices on either side of it in the background. Cached slices are evicted
+    least recently used first once they exceed ``budget`` bytes.
+    """
+
+    def __init__(self, paths, budget=PAGER_BUDGET, prefetch=PAGER_PREFETCH, reader=read_slice):
+        self.paths = paths
+        self.budget = budget
+        self.prefetch = prefetch
+        self.reader = reader
+        self.nbytes = 0
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(2)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        with self._lock:
+            img = self._cache.get(index)
+            if img is not None:
+                self._cache.move_to_end(index)
+            future = self._pending.get(index)
+        if img is None:
+            img = future.result() if future is not None else self._load(index)
+        self.prefetch_around(index)
+        return img
+
+    def prefetch_around(self, index):
+        # Keep the window small enough that prefetching never evicts the slice being shown
+        window = self.prefetch
+        if self.nbytes and self._cache:
+            slice_bytes = self.nbytes / len(self._cache)
+            window = min(window, int(self.budget // slice_bytes - 1) // 2)
+        for offset in range(1, window + 1):
+            for i in (index + offset, index - offset):
+                if 0 <= i < len(self):
+                    with self._lock:
+                        if i in self._cache or i in self._pending:
+                            continue
+                        self._pending[i] = self._executor.submit(self._load, i)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load(self, index):
+        img = self.reader(self.paths[index])
+        with self._lock:
+            self._pending.pop(index, None)
+            if index not in self._cache:
+                self._cache[index] = img
+                self.nbytes += img.nbytes
+            while self.nbytes > self.budget and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return img
+
+
+def open_store(directory, template=None, native=None):
+    # A packed .svol file is opened like a slice directory; its slice order was fixed when it was packed
+    directory = os.path.abspath(directory)
+    native = NATIVE_LOADING if native is None else native
+    if is_chunked_volume(directory):
+        template, native = None, False
+    store = _stores.get((directory, template, native))
+    if store is None or store.is_stale():
+        store = (ChunkedStore(directory) if is_chunked_volume(directory)
+                 else VolumeStore(directory, template=template, native=native))
+        _stores[(directory, template, native)] = store
+    return store